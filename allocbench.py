@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+Allocation benchmark for the message classes.  Compares the __slots__
+classes in messages.py with plain __dict__-based classes of the same shape:
+bytes per object and time to create a batch of them.
+"""
+
+import sys
+import timeit
+from optparse import OptionParser
+
+from messages import Upload, Request, Download, PeerInfo
+
+
+class DictUpload:
+    def __init__(self, from_id, to_id, up_bw):
+        self.from_id = from_id
+        self.to_id = to_id
+        self.bw = up_bw
+
+class DictRequest:
+    def __init__(self, requester_id, peer_id, piece_id, start):
+        self.requester_id = requester_id
+        self.peer_id = peer_id
+        self.piece_id = piece_id
+        self.start = start
+
+class DictDownload:
+    def __init__(self, from_id, to_id, piece, blocks):
+        self.from_id = from_id
+        self.to_id = to_id
+        self.piece = piece
+        self.blocks = blocks
+
+class DictPeerInfo:
+    def __init__(self, id, available):
+        self.id = id
+        self.available_pieces = frozenset(available)
+
+
+# (name, slots class, dict class, constructor args)
+CASES = [
+    ("Upload", Upload, DictUpload, ("Peer1", "Peer2", 4)),
+    ("Request", Request, DictRequest, ("Peer1", "Peer2", 7, 3)),
+    ("Download", Download, DictDownload, ("Peer1", "Peer2", 7, 4)),
+    ("PeerInfo", PeerInfo, DictPeerInfo, ("Peer1", [1, 2, 3])),
+]
+
+
+def object_size(obj):
+    """Bytes taken by obj itself, plus its __dict__ if it has one.  The
+    attribute values are shared, so they aren't counted."""
+    size = sys.getsizeof(obj)
+    d = getattr(obj, "__dict__", None)
+    if d is not None:
+        size += sys.getsizeof(d)
+    return size
+
+
+def create_time(cls, args, n, repeat):
+    """Best time, in seconds, to create n instances of cls."""
+    def create():
+        for i in xrange(n):
+            cls(*args)
+    return min(timeit.repeat(create, number=1, repeat=repeat))
+
+
+def main(args):
+    parser = OptionParser(usage="Usage:  %prog [options]")
+    parser.add_option("-n", dest="n", default=100000, type="int",
+                      help="Objects created per timing run")
+    parser.add_option("--repeat", dest="repeat", default=5, type="int",
+                      help="Timing runs per class; the best one is reported")
+    (options, rest) = parser.parse_args(args[1:])
+
+    print "%-10s %12s %12s %14s %14s" % (
+        "class", "dict bytes", "slots bytes", "dict us/obj", "slots us/obj")
+    for (name, slots_cls, dict_cls, ctor_args) in CASES:
+        sizes = [object_size(c(*ctor_args)) for c in (dict_cls, slots_cls)]
+        times = [create_time(c, ctor_args, options.n, options.repeat)
+                 * 1e6 / options.n
+                 for c in (dict_cls, slots_cls)]
+        print "%-10s %12d %12d %14.3f %14.3f" % (
+            name, sizes[0], sizes[1], times[0], times[1])
+
+if __name__ == "__main__":
+    main(sys.argv)
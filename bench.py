@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+"""
+Scaling benchmark for the simulator core.  Runs Sim.run_sim_once over a
+grid of peer counts, piece counts and blocks per piece, and reports the
+wall time spent in each phase (requests, validation, uploads, transfer
+resolution, history update) and the peak memory of each run.
+
+Each run gets a fresh worker process, so its peak memory isn't mixed up
+with the others'.  Results can be written as JSON with --out, and compared
+against an earlier --out file with --baseline.
+
+With --check, every round's transfer resolution is also done the
+reference way (transfer.resolve_transfers_reference) and the two results
+compared, so the runs double as an equivalence test.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import resource
+import itertools
+import multiprocessing
+from optparse import OptionParser
+
+from sim import Sim, configure_logging, make_config
+from util import derive_seed
+from profiling import PhaseTimer
+from transfer import resolve_transfers, resolve_transfers_reference
+
+PHASES = ["requests", "validation", "uploads", "transfer", "history"]
+
+
+def point_config(options, num_peers, num_pieces, blocks_per_piece):
+    """A sim config for one grid point: options.seeds Seed peers, and the
+    rest made of options.agents in turn."""
+    mix = options.agents.split(",")
+    names = ([mix[i % len(mix)] for i in range(num_peers - options.seeds)]
+             + ["Seed"] * options.seeds)
+    return make_config(names,
+                       num_pieces=num_pieces,
+                       blocks_per_piece=blocks_per_piece,
+                       max_round=options.max_round,
+                       min_up_bw=options.min_up_bw,
+                       max_up_bw=options.max_up_bw,
+                       engine=options.engine,
+                       validate=options.validate,
+                       validate_every=options.validate_every,
+                       seed=options.seed)
+
+
+class TransferMismatch(Exception):
+    pass
+
+
+def checked_transfers(requests, uploads, peer_ids, peer_index,
+                      blocks_per_piece, id_order=None):
+    """resolve_transfers(), raising TransferMismatch if it doesn't give
+    what resolve_transfers_reference() does."""
+    args = (requests, uploads, peer_ids, peer_index, blocks_per_piece,
+            id_order)
+    ans = resolve_transfers(*args)
+    expected = resolve_transfers_reference(*args)
+    if ans != expected:
+        for requester_id in sorted(expected):
+            if ans.get(requester_id) != expected[requester_id]:
+                raise TransferMismatch("%s got %s, expected %s" % (
+                    requester_id, ans.get(requester_id),
+                    expected[requester_id]))
+        raise TransferMismatch("requesters %s, expected %s" % (
+            sorted(ans), sorted(expected)))
+    return ans
+
+
+def run_point(job):
+    """
+    job: (options, num_peers, num_pieces, blocks_per_piece)
+
+    Run one simulation with a PhaseTimer and return a dict of results.
+    Meant to run in a fresh worker process.
+    """
+    (options, num_peers, num_pieces, blocks_per_piece) = job
+    # Agents print from post_init()
+    sys.stdout = open(os.devnull, "w")
+
+    config = point_config(options, num_peers, num_pieces, blocks_per_piece)
+    seed = derive_seed(options.seed, "bench", num_peers, num_pieces,
+                       blocks_per_piece)
+    random.seed(seed)
+    sim = Sim(config, seed)
+    sim.timer = PhaseTimer()
+    if options.check:
+        sim.resolve_transfers = checked_transfers
+    start = time.time()
+    history = sim.run_sim_once()
+    wall = time.time() - start
+    rounds = history.num_rounds
+    history.close()
+
+    phases = dict((p, sim.timer.totals.get(p, 0.0)) for p in PHASES)
+    phases["other"] = wall - sim.timer.total()
+    return {"peers": num_peers,
+            "pieces": num_pieces,
+            "blocks_per_piece": blocks_per_piece,
+            "rounds": rounds,
+            "wall": wall,
+            "phases": phases,
+            # kilobytes on Linux
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def point_key(r):
+    return (r["peers"], r["pieces"], r["blocks_per_piece"])
+
+
+def print_results(results, baseline, tolerance):
+    """
+    Print a table of results.  With a baseline, also print the wall time
+    ratio to it.  Returns the number of grid points that got slower by
+    more than tolerance.
+    """
+    old = dict((point_key(r), r) for r in baseline or [])
+    header = "%6s %6s %4s %6s %9s" % ("peers", "pieces", "bpp", "rounds", "wall")
+    header += "".join(" %10s" % p for p in PHASES + ["other"])
+    header += " %10s" % "peak KB"
+    if baseline is not None:
+        header += " %8s" % "vs base"
+    print header
+
+    regressions = 0
+    for r in results:
+        line = "%6d %6d %4d %6d %9.3f" % (r["peers"], r["pieces"],
+                                          r["blocks_per_piece"], r["rounds"],
+                                          r["wall"])
+        line += "".join(" %10.3f" % r["phases"][p] for p in PHASES + ["other"])
+        line += " %10d" % r["peak_rss"]
+        if baseline is not None:
+            b = old.get(point_key(r))
+            if b is None or b["wall"] == 0:
+                line += " %8s" % "-"
+            else:
+                ratio = r["wall"] / b["wall"]
+                line += " %7.2fx" % ratio
+                if ratio > 1 + tolerance:
+                    line += "  SLOWER"
+                    regressions += 1
+        print line
+    return regressions
+
+
+def parse_ints(s):
+    return [int(x) for x in s.split(",")]
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options]"
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--peers",
+                      dest="peers", default="10,20,40",
+                      help="Comma-separated peer counts (seeds included)")
+
+    parser.add_option("--num-pieces",
+                      dest="num_pieces", default="20,80",
+                      help="Comma-separated numbers of pieces")
+
+    parser.add_option("--blocks-per-piece",
+                      dest="blocks_per_piece", default="4",
+                      help="Comma-separated numbers of blocks per piece")
+
+    parser.add_option("--agents",
+                      dest="agents", default="LkjcStd,LkjcTyrant,LkjcPropShare",
+                      help="Comma-separated agent classes, used in turn for "
+                      "the peers that aren't seeds")
+
+    parser.add_option("--seeds",
+                      dest="seeds", default=2, type="int",
+                      help="Number of Seed peers in each run")
+
+    parser.add_option("--max-round",
+                      dest="max_round", default=200, type="int",
+                      help="Limit on number of rounds")
+
+    parser.add_option("--min-bw",
+                      dest="min_up_bw", default=4, type="int",
+                      help="Min upload bandwidth")
+
+    parser.add_option("--max-bw",
+                      dest="max_up_bw", default=10, type="int",
+                      help="Max upload bandwidth")
+
+    parser.add_option("--engine",
+                      dest="engine", default="array", type="choice",
+                      choices=["dict", "array"],
+                      help="Swarm state storage: 'dict' of lists or flat 'array'")
+
+    parser.add_option("--validate",
+                      dest="validate", default="strict", type="choice",
+                      choices=["strict", "sampled", "off"],
+                      help="Validation mode, as for sim.py")
+
+    parser.add_option("--validate-every",
+                      dest="validate_every", default=10, type="int",
+                      help="In sampled mode, check each peer once every N rounds")
+
+    parser.add_option("--seed",
+                      dest="seed", default=0, type="int",
+                      help="Root random seed, so runs can be compared")
+
+    parser.add_option("--out",
+                      dest="out", default=None,
+                      help="Write the results to this JSON file")
+
+    parser.add_option("--baseline",
+                      dest="baseline", default=None,
+                      help="Compare wall times with this earlier --out file")
+
+    parser.add_option("--tolerance",
+                      dest="tolerance", default=0.1, type="float",
+                      help="Flag grid points more than this fraction slower "
+                      "than the baseline")
+
+    parser.add_option("--check",
+                      dest="check", default=False, action="store_true",
+                      help="Check transfer resolution against the reference "
+                      "version every round (transfer times include both)")
+
+    (options, rest) = parser.parse_args(args[1:])
+
+    grid = list(itertools.product(parse_ints(options.peers),
+                                  parse_ints(options.num_pieces),
+                                  parse_ints(options.blocks_per_piece)))
+    if any(n <= options.seeds for (n, _, _) in grid):
+        parser.error("every peer count must be more than --seeds")
+
+    configure_logging("warning")
+
+    baseline = None
+    if options.baseline is not None:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)["results"]
+        finally:
+            f.close()
+
+    # One process per run, so each run's peak memory is its own
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        results = [pool.apply(run_point, ((options,) + point,))
+                   for point in grid]
+    except TransferMismatch, e:
+        print "Transfer resolution differs from the reference: %s" % e
+        sys.exit(1)
+    finally:
+        pool.close()
+        pool.join()
+
+    regressions = print_results(results, baseline, options.tolerance)
+    if options.check:
+        print "Transfer resolution matched the reference in every round"
+
+    if options.out is not None:
+        f = open(options.out, "w")
+        try:
+            json.dump({"options": dict(vars(options)), "results": results},
+                      f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if regressions > 0:
+        print "%d of %d grid points slower than the baseline" % (
+            regressions, len(results))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
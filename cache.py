@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+"""
+An on-disk cache of simulation results, keyed by a hash of everything that
+determines them: the agents' source code, the config and the seed.  A
+result is recomputed only when one of those changes.
+"""
+
+import os
+import imp
+import json
+import errno
+import hashlib
+import tempfile
+
+# The modules besides the agents' own that decide what a run does
+ENGINE_MODULES = ["sim", "messages", "peer", "swarm", "history", "stats",
+                  "transfer", "util"]
+
+
+def module_source(name):
+    """The source text of a top-level module.  Found by name rather than
+    through sys.modules, which has sim.py as __main__ when it's run."""
+    (f, path, description) = imp.find_module(name)
+    if f is None:
+        raise ImportError("No source for module %s" % name)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def source_digest(agent_classes):
+    """
+    sha1 hex digest of the source of the modules defining agent_classes (a
+    dict class name -> class, as load_modules returns) and of the engine
+    modules.
+    """
+    names = set(c.__module__ for c in agent_classes.values())
+    names.update(ENGINE_MODULES)
+    h = hashlib.sha1()
+    for name in sorted(names):
+        h.update(name + "\0" + module_source(name) + "\0")
+    return h.hexdigest()
+
+
+def result_key(*parts):
+    """A cache key for parts, which must be JSON-serializable."""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+
+class ResultCache:
+    """
+    JSON results in files under dir, one per key, spread over
+    subdirectories by the first two characters of the key.  Writes go to a
+    temporary file that's renamed into place, so parallel workers and
+    interrupted runs never leave a half-written result.
+
+    If max_bytes is set, the least recently used results are deleted when
+    the files add up to more than that.  Reading a result marks it used
+    (by touching the file).  The total is counted by walking the directory
+    on the first put and kept up to date after that, so reuse one
+    ResultCache for many puts.  Other processes' puts aren't counted until
+    the next eviction recounts.
+    """
+    def __init__(self, dir, max_bytes=0):
+        self.dir = dir
+        self.max_bytes = max_bytes
+        self.size = None   # bytes in the cache, counted on the first put
+
+    def path(self, key):
+        return os.path.join(self.dir, key[:2], key + ".json")
+
+    def get(self, key):
+        """The result stored under key, or None."""
+        try:
+            f = open(self.path(key))
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            result = json.load(f)
+        except ValueError:
+            return None   # unreadable: treat as missing
+        finally:
+            f.close()
+        try:
+            os.utime(self.path(key), None)
+        except OSError:
+            pass   # evicted by another process meanwhile
+        return result
+
+    def put(self, key, result):
+        path = self.path(key)
+        d = os.path.dirname(path)
+        try:
+            os.makedirs(d)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        (fd, tmp) = tempfile.mkstemp(dir=d, suffix=".tmp")
+        f = os.fdopen(fd, "w")
+        try:
+            json.dump(result, f)
+        finally:
+            f.close()
+        if self.max_bytes > 0 and self.size is not None:
+            # Replacing a result only adds the difference
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+            self.size += os.path.getsize(tmp) - old_size
+        os.rename(tmp, path)
+
+        if self.max_bytes > 0:
+            if self.size is None:
+                self.size = sum(size for (path, size, mtime) in self.entries())
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        """(path, size, mtime) for each stored result."""
+        ans = []
+        for (dirpath, dirnames, filenames) in os.walk(self.dir):
+            for name in filenames:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                ans.append((path, st.st_size, st.st_mtime))
+        return ans
+
+    def evict(self):
+        """Delete the least recently used results until the cache is down
+        to 90% of max_bytes, so it doesn't evict again on the next put."""
+        entries = self.entries()
+        self.size = sum(size for (path, size, mtime) in entries)
+        target = 0.9 * self.max_bytes
+        for (path, size, mtime) in sorted(entries, key=lambda e: e[2]):
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
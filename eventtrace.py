@@ -0,0 +1,249 @@
+#!/usr/bin/python
+
+"""
+Compact binary event traces of simulation runs.
+
+A trace records, for every round, each peer's requests, uploads and
+downloads, and which peers finished, with peer ids stored as indexes.  It
+holds everything needed to rebuild the run's History (see replay()), so new
+stats can be computed over old runs without simulating them again.
+
+File layout (all integers and doubles in the byte order given in the header):
+
+  header:  "BTTRACE1", byte order ('L' or 'B'),
+           num_pieces, blocks_per_piece, number of peers   (3 x int32)
+           seed of the traced run (Sim.seed, not --seed)   (int64)
+           per peer: id (string), upload rate (double)
+  records: 'I' new id    -- index (int32), id (string)
+           'R' round     -- see TraceWriter.write_round
+           'E' end of run
+
+Strings are a type byte ('S' string, 'N' None) followed, for strings, by a
+uint16 length and utf-8 bytes.  An id that isn't a peer (say, an upload to
+None) gets an 'I' record before the round that first uses it.
+"""
+
+import struct
+import sys
+from array import array
+
+from messages import Request, Upload, Download
+from history import History
+
+MAGIC = "BTTRACE1"
+BYTE_ORDER = 'L' if sys.byteorder == "little" else 'B'
+
+
+class TraceError(Exception):
+    pass
+
+
+def is_int(x):
+    return isinstance(x, (int, long))
+
+
+class TraceWriter:
+    """Writes one run's events to a trace file as the run goes."""
+    def __init__(self, path, peer_ids, upload_rates, config, seed):
+        """seed: the seed the run itself was given, which reproduces it"""
+        self.f = open(path, "wb")
+        self.peer_ids = peer_ids[:]
+        self.ids = self.peer_ids[:]
+        self.index = dict((pid, i) for (i, pid) in enumerate(self.ids))
+
+        self.f.write(MAGIC + BYTE_ORDER)
+        self.f.write(struct.pack("=iiiq", config.num_pieces,
+                                 config.blocks_per_piece, len(peer_ids),
+                                 seed))
+        for pid in peer_ids:
+            self.write_string(pid)
+            self.f.write(struct.pack("=d", upload_rates[pid]))
+
+    def write_string(self, s):
+        if s is None:
+            self.f.write("N")
+            return
+        if isinstance(s, unicode):
+            s = s.encode("utf-8")
+        s = str(s)
+        self.f.write("S" + struct.pack("=H", len(s)) + s)
+
+    def intern(self, x):
+        i = self.index.get(x)
+        if i is None:
+            i = len(self.ids)
+            self.ids.append(x)
+            self.index[x] = i
+            self.f.write("I" + struct.pack("=i", i))
+            self.write_string(x)
+        return i
+
+    def write_round(self, round, requests, uploads, downloads, done):
+        """
+        requests, uploads, downloads: dict peer_id -> list, as the sim has
+            them at the end of the round
+        done: ids of peers that finished this round
+
+        Writes the round number, then for each of requests, uploads and
+        downloads a per-peer count array followed by its columns, then the
+        finished peers' indexes:
+
+          requests:  requester, peer, piece (int32), start (double), is_int
+          uploads:   from, to (int32), bw (double), is_int
+          downloads: from, to, piece (int32), blocks (double), is_int
+        """
+        intern = self.intern
+        # Intern everything first, so 'I' records come before the round
+        cols = []
+        for (msgs, fields) in ((requests, ("requester_id", "peer_id")),
+                               (uploads, ("from_id", "to_id")),
+                               (downloads, ("from_id", "to_id"))):
+            counts = array('i')
+            id_cols = [array('i') for f in fields]
+            for pid in self.peer_ids:
+                ms = msgs[pid]
+                counts.append(len(ms))
+                for (col, field) in zip(id_cols, fields):
+                    col.extend(intern(getattr(m, field)) for m in ms)
+            cols.append((counts, id_cols))
+
+        self.f.write("R" + struct.pack("=i", round))
+        for ((counts, id_cols), msgs, fields) in zip(
+                cols, (requests, uploads, downloads),
+                (("piece_id", "start"), (None, "bw"), ("piece", "blocks"))):
+            (int_field, num_field) = fields
+            ms = [m for pid in self.peer_ids for m in msgs[pid]]
+            counts.tofile(self.f)
+            for col in id_cols:
+                col.tofile(self.f)
+            if int_field is not None:
+                array('i', (getattr(m, int_field) for m in ms)).tofile(self.f)
+            array('d', (getattr(m, num_field) for m in ms)).tofile(self.f)
+            array('b', (is_int(getattr(m, num_field)) for m in ms)).tofile(self.f)
+
+        done_idx = array('i', (self.index[pid] for pid in done))
+        self.f.write(struct.pack("=i", len(done_idx)))
+        done_idx.tofile(self.f)
+
+    def close(self):
+        self.f.write("E")
+        self.f.close()
+
+
+class TraceRound:
+    """
+    One round read back from a trace.
+
+    requests, uploads, downloads: dict peer_id -> list of message objects
+    done: list of ids of peers that finished this round
+    """
+    def __init__(self, round, requests, uploads, downloads, done):
+        self.round = round
+        self.requests = requests
+        self.uploads = uploads
+        self.downloads = downloads
+        self.done = done
+
+
+class TraceReader:
+    """
+    Reads a trace file.  The header fields are attributes; rounds() yields
+    TraceRound objects in order.
+    """
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        magic = self.f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise TraceError("%s is not a trace file" % path)
+        self.swap = self.f.read(1) != BYTE_ORDER
+
+        (self.num_pieces, self.blocks_per_piece, n,
+         self.seed) = self.unpack("=iiiq")
+        self.peer_ids = []
+        self.upload_rates = dict()
+        for i in range(n):
+            pid = self.read_string()
+            self.peer_ids.append(pid)
+            (self.upload_rates[pid],) = self.unpack("=d")
+        self.ids = self.peer_ids[:]
+
+    def unpack(self, fmt):
+        data = self.f.read(struct.calcsize(fmt))
+        if self.swap:
+            fmt = (">" if BYTE_ORDER == 'L' else "<") + fmt[1:]
+        return struct.unpack(fmt, data)
+
+    def read_array(self, typecode, n):
+        a = array(typecode)
+        a.fromfile(self.f, n)
+        if self.swap:
+            a.byteswap()
+        return a
+
+    def read_string(self):
+        t = self.f.read(1)
+        if t == "N":
+            return None
+        (n,) = self.unpack("=H")
+        return self.f.read(n)
+
+    def read_group(self, n_ids, has_int, build):
+        """Read one of the request/upload/download groups of a round."""
+        counts = self.read_array('i', len(self.peer_ids))
+        total = sum(counts)
+        id_cols = [self.read_array('i', total) for i in range(n_ids)]
+        ints = self.read_array('i', total) if has_int else None
+        nums = self.read_array('d', total)
+        is_int = self.read_array('b', total)
+
+        ids = self.ids
+        ans = dict()
+        k = 0
+        for (pid, count) in zip(self.peer_ids, counts):
+            ms = []
+            for j in xrange(k, k + count):
+                num = int(nums[j]) if is_int[j] else nums[j]
+                args = [ids[col[j]] for col in id_cols]
+                if has_int:
+                    args.append(ints[j])
+                args.append(num)
+                ms.append(build(*args))
+            ans[pid] = ms
+            k += count
+        return ans
+
+    def rounds(self):
+        while True:
+            tag = self.f.read(1)
+            if tag == "I":
+                (i,) = self.unpack("=i")
+                self.ids.append(self.read_string())
+            elif tag == "R":
+                (round,) = self.unpack("=i")
+                requests = self.read_group(2, True, Request)
+                uploads = self.read_group(2, False, Upload)
+                downloads = self.read_group(2, True, Download)
+                (n_done,) = self.unpack("=i")
+                done = [self.ids[i] for i in self.read_array('i', n_done)]
+                yield TraceRound(round, requests, uploads, downloads, done)
+            elif tag == "E":
+                return
+            else:
+                raise TraceError("Bad record tag %r (truncated trace?)" % tag)
+
+    def close(self):
+        self.f.close()
+
+
+def replay(path):
+    """Rebuild the History of the run traced in path."""
+    reader = TraceReader(path)
+    try:
+        history = History(reader.peer_ids, reader.upload_rates)
+        for r in reader.rounds():
+            history.update(r.downloads, r.uploads)
+            for pid in r.done:
+                history.peer_is_done(r.round, pid)
+    finally:
+        reader.close()
+    return history
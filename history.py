@@ -1,7 +1,15 @@
 #!/usr/bin/python
 
+import sys
 import copy
+import mmap
+import base64
 import pprint
+import tempfile
+from array import array
+
+from messages import Download, Upload, UploadBatch
+from stats import StatsAccumulator
 
 
 class AgentHistory:
@@ -14,6 +22,8 @@ class AgentHistory:
     history.uploads: [[Upload objects for round]]  (one sublist for each round)
          All the downloads _from_ this agent.
 
+    Both are RoundsViews: the sublist for a round is built when indexed.
+
     """
     def __init__(self, peer_id, downloads, uploads):
         """
@@ -32,12 +42,58 @@ class AgentHistory:
 
     def __repr__(self):
         return "AgentHistory(downloads=%s, uploads=%s)" % (
-            pprint.pformat(self.downloads),
-            pprint.pformat(self.uploads))
+            pprint.pformat(list(self.downloads)),
+            pprint.pformat(list(self.uploads)))
+
+
+class RoundsView:
+    """
+    One peer's downloads or uploads, one list per round, that looks like a
+    list of lists.  The list for a round is built from the History columns
+    when it's indexed, so nothing is kept around as objects.
+    """
+    def __init__(self, history, peer_index, build):
+        """
+        build: function (round, peer_index) -> list for that round
+        """
+        self._history = history
+        self._peer_index = peer_index
+        self._build = build
+
+    def __len__(self):
+        return self._history.num_rounds
+
+    def __getitem__(self, r):
+        if isinstance(r, slice):
+            return [self[i] for i in xrange(*r.indices(len(self)))]
+        n = len(self)
+        if r < 0:
+            r += n
+        if r < 0 or r >= n:
+            raise IndexError("round index out of range")
+        return self._build(r, self._peer_index)
+
+    def __iter__(self):
+        for r in xrange(len(self)):
+            yield self._build(r, self._peer_index)
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 class History:
-    """History of the whole sim"""
+    """History of the whole sim
+
+    Transfers are kept in columns (parallel arrays) rather than as lists of
+    objects.  Each round's downloads are stored grouped by the peer that
+    received them, and each round's uploads by the peer that sent them, so
+    one peer's transfers for one round are a contiguous slice.
+
+    Peer ids in the columns are stored as indexes into self.ids, which
+    starts out as the peer ids and grows if an upload names some other id.
+    Amounts are stored as doubles, with a flag for whether the agent used
+    an int, so the objects rebuilt from them are exactly what went in.
+    """
     def __init__(self, peer_ids, upload_rates):
         """
         uploads:
@@ -46,25 +102,200 @@ class History:
                    dict : peer_id -> [[downloads] -- one list per round]
                    
         Keep track of the uploads _from_ and downloads _to_ the
-        specified peer id.
+        specified peer id.  The per-round lists are built on demand.
         """
         self.upload_rates = upload_rates  # peer_id -> up_bw
         self.peer_ids = peer_ids[:]
 
         self.round_done = dict()   # peer_id -> round finished
-        self.downloads = dict((pid, []) for pid in peer_ids)
-        self.uploads = dict((pid, []) for pid in peer_ids)
+        self.totals = StatsAccumulator(self.peer_ids)
+
+        self.ids = self.peer_ids[:]
+        self.id_index = dict((pid, i) for (i, pid) in enumerate(self.ids))
+        self.num_rounds = 0
+        self.batch_ids = None   # last peer id list same_ids() matched
+
+        # Download columns: (from, to, piece, blocks).  Round r's downloads
+        # to peer i are rows d_offsets[r*n + i] up to d_offsets[r*n + i + 1],
+        # where n is the number of peers.
+        self.d_from = array('i')
+        self.d_to = array('i')
+        self.d_piece = array('i')
+        self.d_blocks = array('d')
+        self.d_is_int = array('b')
+        self.d_offsets = array('l', [0])
+
+        # Upload columns: (from, to, bw), laid out the same way by uploader.
+        self.u_from = array('i')
+        self.u_to = array('i')
+        self.u_bw = array('d')
+        self.u_is_int = array('b')
+        self.u_offsets = array('l', [0])
+
+        self.downloads = dict((pid, RoundsView(self, i, self.download_list))
+                              for (i, pid) in enumerate(self.peer_ids))
+        self.uploads = dict((pid, RoundsView(self, i, self.upload_list))
+                            for (i, pid) in enumerate(self.peer_ids))
+
+    def intern(self, peer_id):
+        """Return the column index for peer_id, adding it if it's new."""
+        i = self.id_index.get(peer_id)
+        if i is None:
+            i = len(self.ids)
+            self.ids.append(peer_id)
+            self.id_index[peer_id] = i
+        return i
 
     def update(self, dls, ups):
         """
         dls: dict : peer_id -> [downloads] -- downloads for this round
-        ups: dict : peer_id -> [uploads] -- uploads for this round
+        ups: dict : peer_id -> [uploads] or UploadBatch -- uploads for
+             this round
 
         append these downloads to to the history
         """
+        intern = self.intern
         for pid in self.peer_ids:
-            self.downloads[pid].append(dls[pid])
-            self.uploads[pid].append(ups[pid])
+            ds = dls[pid]
+            self.totals.add_downloads(ds)
+            for d in ds:
+                self.d_from.append(intern(d.from_id))
+                self.d_to.append(intern(d.to_id))
+                self.d_piece.append(d.piece)
+                self.d_blocks.append(d.blocks)
+                self.d_is_int.append(isinstance(d.blocks, (int, long)))
+            self.d_offsets.append(self.d_offsets[-1] + len(ds))
+
+            us = ups[pid]
+            if (isinstance(us, UploadBatch) and self.same_ids(us.peer_ids)
+                and (len(us) == 0 or min(us.peers) >= 0)):
+                # Batch peer indexes are the same as column indexes
+                self.u_from.extend(array('i', [intern(us.from_id)]) * len(us))
+                self.u_to.extend(us.peers)
+                self.u_bw.extend(us.bws)
+                self.u_is_int.extend(us.bws_int)
+                self.u_offsets.append(self.u_offsets[-1] + len(us))
+                continue
+            for u in us:
+                self.u_from.append(intern(u.from_id))
+                self.u_to.append(intern(u.to_id))
+                self.u_bw.append(u.bw)
+                self.u_is_int.append(isinstance(u.bw, (int, long)))
+            self.u_offsets.append(self.u_offsets[-1] + len(us))
+        self.num_rounds += 1
+
+    def same_ids(self, peer_ids):
+        """
+        Whether peer_ids lists our peers in our order, so that its indexes
+        are column indexes.  Only compared once per list.
+        """
+        if peer_ids is not self.batch_ids:
+            if list(peer_ids) != self.peer_ids:
+                return False
+            self.batch_ids = peer_ids
+        return True
+
+    def rows(self, offsets, r, i):
+        """Return the (start, end) rows for round r, peer index i."""
+        k = r * len(self.peer_ids) + i
+        return (offsets[k], offsets[k + 1])
+
+    def download_columns(self, r, start, end):
+        """
+        Return (from, to, piece, blocks, is_int) arrays for download rows
+        start up to end, which are all in round r.
+        """
+        return (self.d_from[start:end], self.d_to[start:end],
+                self.d_piece[start:end], self.d_blocks[start:end],
+                self.d_is_int[start:end])
+
+    def upload_columns(self, r, start, end):
+        """
+        Return (from, to, bw, is_int) arrays for upload rows start up to
+        end, which are all in round r.
+        """
+        return (self.u_from[start:end], self.u_to[start:end],
+                self.u_bw[start:end], self.u_is_int[start:end])
+
+    def download_list(self, r, i):
+        """Build the list of Downloads to peer index i in round r."""
+        (start, end) = self.rows(self.d_offsets, r, i)
+        (froms, tos, pieces, blocks, is_int) = self.download_columns(r, start, end)
+        ids = self.ids
+        ans = []
+        for k in xrange(end - start):
+            b = int(blocks[k]) if is_int[k] else blocks[k]
+            ans.append(Download(ids[froms[k]], ids[tos[k]], pieces[k], b))
+        return ans
+
+    def upload_list(self, r, i):
+        """Build the list of Uploads from peer index i in round r."""
+        (start, end) = self.rows(self.u_offsets, r, i)
+        (froms, tos, bws, is_int) = self.upload_columns(r, start, end)
+        ids = self.ids
+        ans = []
+        for k in xrange(end - start):
+            bw = int(bws[k]) if is_int[k] else bws[k]
+            ans.append(Upload(ids[froms[k]], ids[tos[k]], bw))
+        return ans
+
+    def close(self):
+        """Release any resources held.  Nothing to do in memory."""
+        pass
+
+    # Columns saved by compact(), in order
+    COLUMNS = ["d_from", "d_to", "d_piece", "d_blocks", "d_is_int",
+               "u_from", "u_to", "u_bw", "u_is_int"]
+
+    def compact(self):
+        """
+        Return the whole history as a JSON-able dict: the ids, who finished
+        when, and each column's raw bytes, base64-encoded.
+        from_compact() turns it back into a History.
+        """
+        n = len(self.peer_ids)
+        cols = dict((name, array(getattr(self, name).typecode))
+                    for name in self.COLUMNS)
+        for r in range(self.num_rounds):
+            for (kind, offsets, read) in (
+                    ("d", self.d_offsets, self.download_columns),
+                    ("u", self.u_offsets, self.upload_columns)):
+                names = [c for c in self.COLUMNS if c.startswith(kind)]
+                for (name, col) in zip(names, read(r, offsets[r * n],
+                                                   offsets[(r + 1) * n])):
+                    cols[name].extend(col)
+        return {"peer_ids": self.peer_ids,
+                "upload_rates": self.upload_rates,
+                "ids": self.ids,
+                "round_done": self.round_done,
+                "num_rounds": self.num_rounds,
+                "byteorder": sys.byteorder,
+                "d_offsets": self.d_offsets.tolist(),
+                "u_offsets": self.u_offsets.tolist(),
+                "columns": dict((name, base64.b64encode(col.tostring()))
+                                for (name, col) in cols.items())}
+
+    @classmethod
+    def from_compact(cls, data):
+        """Rebuild an in-memory History from what compact() returned."""
+        h = History(data["peer_ids"], data["upload_rates"])
+        for pid in data["ids"]:
+            h.intern(pid)
+        h.round_done.update(data["round_done"])
+        h.num_rounds = data["num_rounds"]
+        h.d_offsets = array('l', data["d_offsets"])
+        h.u_offsets = array('l', data["u_offsets"])
+        for name in cls.COLUMNS:
+            col = array(getattr(h, name).typecode)
+            col.fromstring(base64.b64decode(data["columns"][name]))
+            if data["byteorder"] != sys.byteorder:
+                col.byteswap()
+            setattr(h, name, col)
+        # The running totals are rebuilt the way update() adds them up
+        for r in range(h.num_rounds):
+            for i in range(len(h.peer_ids)):
+                h.totals.add_downloads(h.download_list(r, i))
+        return h
 
     def peer_is_done(self, round, peer_id):
         # Only save the _first_ round where we hear this
@@ -80,25 +311,139 @@ class History:
         return len(self.downloads[p])-1
 
     def pretty_for_round(self, r):
-        s = "\nRound %s:\n" % r
+        parts = ["\nRound %s:\n" % r]
         for peer_id in self.peer_ids:
             ds = self.downloads[peer_id][r]
             stringify = lambda d: "%s downloaded %d blocks of piece %d from %s\n" % (
                 peer_id, d.blocks, d.piece, d.from_id)
-            s += "".join(map(stringify, ds))
-        return s
+            parts.extend(map(stringify, ds))
+        return "".join(parts)
 
-    def pretty(self):
-        s = "History\n"
+    def write_pretty(self, f):
+        """Write pretty() to file f a round at a time, without building
+        the whole string."""
+        f.write("History\n")
         for r in range(self.last_round()+1):
-            s += self.pretty_for_round(r)
-        return s
+            f.write(self.pretty_for_round(r))
+
+    def pretty(self):
+        return "History\n" + "".join(self.pretty_for_round(r)
+                                     for r in range(self.last_round()+1))
 
     def __repr__(self):
         return """History(
 uploads=%s
 downloads=%s
 )""" % (
-    pprint.pformat(self.uploads),
-    pprint.pformat(self.downloads))
+    pprint.pformat(dict((k, list(v)) for (k, v) in self.uploads.items())),
+    pprint.pformat(dict((k, list(v)) for (k, v) in self.downloads.items())))
+
+
+
+class SpillingHistory(History):
+    """
+    A History that keeps only the last `window` rounds in memory.  Older
+    rounds are appended to a binary file (each column's raw bytes, one
+    round after another) and read back through mmap when asked for.
+    Everything else, including the offsets and the lazy views, works the
+    same as History, so Stats and AgentHistory don't know the difference.
+    """
+    def __init__(self, peer_ids, upload_rates, window, dir=None):
+        """
+        window: number of most recent rounds to keep in memory
+        dir: where to put the spill file (a deleted-on-close temp file)
+        """
+        History.__init__(self, peer_ids, upload_rates)
+        self.window = window
+        self.file = tempfile.TemporaryFile(prefix="history", dir=dir)
+        self.map = None
+
+        self.spilled_rounds = 0
+        # Rows moved to disk so far.  Row k of a hot column is global row
+        # k + base.
+        self.d_base = 0
+        self.u_base = 0
+        # file position of each spilled round's download / upload block
+        self.d_pos = array('l')
+        self.u_pos = array('l')
+
+    def update(self, dls, ups):
+        History.update(self, dls, ups)
+        while self.num_rounds - self.spilled_rounds > self.window:
+            self.spill_round()
+
+    def round_rows(self, offsets, r):
+        n = len(self.peer_ids)
+        return (offsets[r * n], offsets[(r + 1) * n])
+
+    def spill_round(self):
+        """Move the oldest in-memory round to the end of the file."""
+        r = self.spilled_rounds
+        self.file.seek(0, 2)
+
+        (start, end) = self.round_rows(self.d_offsets, r)
+        cols = (self.d_from, self.d_to, self.d_piece, self.d_blocks,
+                self.d_is_int)
+        self.d_pos.append(self.file.tell())
+        for col in cols:
+            self.file.write(col[:end - start].tostring())
+            del col[:end - start]
+        self.d_base = end
+
+        (start, end) = self.round_rows(self.u_offsets, r)
+        cols = (self.u_from, self.u_to, self.u_bw, self.u_is_int)
+        self.u_pos.append(self.file.tell())
+        for col in cols:
+            self.file.write(col[:end - start].tostring())
+            del col[:end - start]
+        self.u_base = end
+
+        self.spilled_rounds += 1
+
+    def read_columns(self, pos, round_size, lo, hi, typecodes):
+        """
+        Read rows lo up to hi of a spilled block at file position pos,
+        holding round_size rows per column, one column per typecode.
+        """
+        if lo == hi:
+            return tuple(array(t) for t in typecodes)
+
+        self.file.flush()
+        self.file.seek(0, 2)
+        if self.map is None or len(self.map) < self.file.tell():
+            # The file grew since it was last mapped
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        cols = []
+        for t in typecodes:
+            col = array(t)
+            w = col.itemsize
+            col.fromstring(self.map[pos + lo * w:pos + hi * w])
+            cols.append(col)
+            pos += round_size * w
+        return tuple(cols)
+
+    def download_columns(self, r, start, end):
+        if r >= self.spilled_rounds:
+            return History.download_columns(self, r, start - self.d_base,
+                                            end - self.d_base)
+        (first, last) = self.round_rows(self.d_offsets, r)
+        return self.read_columns(self.d_pos[r], last - first,
+                                 start - first, end - first, "iiidb")
+
+    def upload_columns(self, r, start, end):
+        if r >= self.spilled_rounds:
+            return History.upload_columns(self, r, start - self.u_base,
+                                          end - self.u_base)
+        (first, last) = self.round_rows(self.u_offsets, r)
+        return self.read_columns(self.u_pos[r], last - first,
+                                 start - first, end - first, "iidb")
 
+    def close(self):
+        """Drop the spill file."""
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
@@ -6,10 +6,9 @@
 # You'll want to copy this file to AgentNameXXX.py for various versions of XXX,
 # probably get rid of the silly logging messages, and then add more logic.
 
-import random
 import logging
 
-from messages import Upload, Request
+from messages import Upload
 from util import even_split
 from peer import Peer
 
@@ -29,62 +28,8 @@ class LkjcPropShare(Peer):
 
         This will be called after update_pieces() with the most recent state.
         """
-        needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
-        needed_pieces = filter(needed, range(len(self.pieces)))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
-
-        requests = []   # We'll put all the things we want here
-        # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
-
-        # request all available pieces from all peers!
-        # (up to self.max_requests from each)
-
         # rarest first strategy
-        piece_peers = dict()
-        piece_counts = dict()
-        n_requests = dict()
-
-        for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
-            n_requests[peer.id] = 0
-            # n = min(self.max_requests, len(isect))
-            for piece_id in list(isect):
-                if piece_id not in piece_peers:
-                    piece_peers[piece_id] = [peer.id]
-                    piece_counts[piece_id] = 0
-                else:
-                    piece_peers[piece_id].append(peer.id)
-                    piece_counts[piece_id] += 0
-
-        counts_piece = dict()
-        for piece, count in piece_counts.items():
-            if count in counts_piece:
-                counts_piece[count].append(piece)
-            else:
-                counts_piece[count] = [piece]
-
-        rarest = sorted(counts_piece.items())
-
-
-        for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
-            n = min(self.max_requests, len(isect))
-            count = 0
-            while count < n:
-                for c, piece_id_list in rarest:
-                    # eliminate symmetry
-                    random.shuffle(piece_id_list)
-                    for piece_id in piece_id_list:
-                        if piece_id in av_set:
-                            count += 1
-                            start_block = self.pieces[piece_id]
-                            r = Request(self.id, peer.id, piece_id, start_block)
-                            requests.append(r)
-
-        return requests
+        return self.rarest_first_requests(peers)
 
     def uploads(self, requests, peers, history):
         """
@@ -98,8 +43,7 @@ class LkjcPropShare(Peer):
         """
 
         round = history.current_round()
-        logging.debug("%s again.  It's round %d." % (
-            self.id, round))
+        logging.debug("%s again.  It's round %d.", self.id, round)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
@@ -137,7 +81,7 @@ class LkjcPropShare(Peer):
 
                 others = list(set(requester_ids) - set(sorted_ids))
                 if len(others) > 0:
-                    optimistic = random.choice(others)
+                    optimistic = self.rng.choice(others)
                     chosen.append(optimistic)
                     bws.append(self.up_bw-sum(bws))
 
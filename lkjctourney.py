@@ -6,13 +6,11 @@
 # You'll want to copy this file to AgentNameXXX.py for various versions of XXX,
 # probably get rid of the silly logging messages, and then add more logic.
 
-import random
 import logging
-from datetime import datetime
 
-from messages import Upload, Request
+from messages import Upload
 from util import even_split
-from peer import Peer
+from peer import Peer, ReciprocationEstimator
 
 class LkjcTourney(Peer):
     def post_init(self):
@@ -23,9 +21,7 @@ class LkjcTourney(Peer):
         self.r = 3
         self.alpha = 0.2
         self.cap = self.up_bw
-        self.flows = dict()
-        self.taus = dict()
-        self.unchoked_past = dict()
+        self.estimator = None
     
     def requests(self, peers, history):
         """
@@ -36,58 +32,27 @@ class LkjcTourney(Peer):
 
         This will be called after update_pieces() with the most recent state.
         """
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
+            needed_pieces = filter(needed, range(len(self.pieces)))
+            logging.debug("%s here: still need pieces %s",
+                          self.id, needed_pieces)
 
-        needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
-        needed_pieces = filter(needed, range(len(self.pieces)))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
-
-
-        logging.debug("%s here: still need pieces %s" % (
-            self.id, needed_pieces))
-
-        logging.debug("%s still here. Here are some peers:" % self.id)
-        for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+            logging.debug("%s still here. Here are some peers:", self.id)
+            for p in peers:
+                logging.debug("id: %s, available pieces: %s",
+                              p.id, p.available_pieces)
 
-        logging.debug("And look, I have my entire history available too:")
-        logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+            logging.debug("And look, I have my entire history available too:")
+            logging.debug("look at the AgentHistory class in history.py for details")
+            logging.debug("%s", history)
 
-        requests = []   # We'll put all the things we want here
-        # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
-        
         # Sort peers by id.  This is probably not a useful sort, but other 
         # sorts might be useful
-        peers.sort(key=lambda p: p.id)
-        # request all available pieces from all peers!
-        # (up to self.max_requests from each)
+        peers = sorted(peers, key=lambda p: p.id)
 
         # rarest first strategy
-        piece_peers = dict()
-        n_requests = dict()
-
-        for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
-            n_requests[peer.id] = 0
-            # n = min(self.max_requests, len(isect))
-            for piece_id in list(isect):
-                if piece_id not in piece_peers:
-                    piece_peers[piece_id] = [peer]
-                else:
-                    piece_peers[piece_id].append(peer)
-
-        # sort pieces by rarest
-        rarest = sorted(piece_peers, key=lambda k: len(piece_peers[k]), reverse=False)
-        for piece in rarest:
-            for peer in piece_peers[piece]:
-                if n_requests[peer.id] < self.max_requests:
-                    n_requests[peer.id] += 1
-                    start_block = self.pieces[piece_id]
-                    r = Request(self.id, peer.id, piece_id, start_block)
-                    requests.append(r)
-        return requests
+        return self.rarest_first_requests(peers)
 
     def uploads(self, requests, peers, history):
         """
@@ -101,8 +66,7 @@ class LkjcTourney(Peer):
         """
 
         round = history.current_round()
-        logging.debug("%s again.  It's round %d." % (
-            self.id, round))
+        logging.debug("%s again.  It's round %d.", self.id, round)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
@@ -110,26 +74,16 @@ class LkjcTourney(Peer):
 
          # Initialize f_j and t_j for all peers
         if round == 0:
-            for peer in peers:
-                self.flows[peer.id] = self.up_bw / 4
-                self.taus[peer.id] = 1
-                # how many times has this peer unchoked me before?
-                self.unchoked_past[peer.id] = 0
+            self.estimator = ReciprocationEstimator(
+                self.peer_ids, self.peer_index, self.up_bw / 4, 1)
+        est = self.estimator
 
         chosen = []
         bws = []
         if len(requests) == 0:
             logging.debug("No one wants my pieces!")
         else:
-            request_ids = []
-            for request in requests:
-                request_ids.append(request.requester_id)
-
-            # step 4
-            # sort peers by decreasing ratio of reciprocation likelihood
-            ratios = dict()
-            for peer in request_ids:
-                ratios[peer] = self.flows[peer]/self.taus[peer]
+            request_ids = requests.requester_ids
 
             # assign "importance" indexes to peers based on how many pieces they have that I need
             needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
@@ -148,12 +102,15 @@ class LkjcTourney(Peer):
 
             # pick uploads
             ul = 0
-            sorted_peers = sorted(ratios, key=lambda k: ratios[k], reverse=False)
+            # step 4
+            # peers by increasing ratio of reciprocation likelihood, so the
+            # best is popped first
+            sorted_peers = est.ranked(request_ids)
+            sorted_peers.reverse()
             logging.debug(sorted_peers)
-            random.seed(datetime.now())
             while ul < self.cap and len(sorted_peers) > 0:
                 # randomly vary to sometimes choose "important" peers over most efficient
-                if random.random() <= 0.02 * len(chosen) and len(importance) > 0:
+                if self.rng.random() <= 0.02 * len(chosen) and len(importance) > 0:
                     candidate = importance.pop()
                     while candidate in chosen:
                         candidate = importance.pop()
@@ -162,10 +119,11 @@ class LkjcTourney(Peer):
                     candidate = sorted_peers.pop()
                     while candidate in chosen:
                         candidate = sorted_peers.pop()
-                if (ul + self.taus[candidate]) < self.cap:
+                tau = est.tau(candidate)
+                if (ul + tau) < self.cap:
                     chosen.append(candidate)
-                    bws.append(self.taus[candidate])
-                ul += self.taus[candidate]
+                    bws.append(tau)
+                ul += tau
 
             """
             logging.debug("Still here: uploading to a random peer")
@@ -185,19 +143,22 @@ class LkjcTourney(Peer):
         # find peers who unchoked me and update
         unchokers = set()
         for dl in history.downloads[round-1]:
-            # update flow with observed flow
-            self.flows[dl.from_id] = dl.blocks
             unchokers.add(dl.from_id)
             # increment unchoked_past
-            self.unchoked_past[dl.from_id] += 1
-            # if peer j has unchoked i for each of last r rounds, then decrease tau_j
-            if self.unchoked_past[dl.from_id] > self.r:
-                self.taus[dl.from_id] *= (1-self.gamma)
+            unchoked_past = est.streak(dl.from_id) + 1
+            est.set_streak(dl.from_id, unchoked_past)
+            # update flow with observed flow, and if peer j has unchoked i
+            # for each of last r rounds, then decrease tau_j
+            if unchoked_past > self.r:
+                est.set(dl.from_id, flow=dl.blocks,
+                        tau=est.tau(dl.from_id)*(1-self.gamma))
+            else:
+                est.set(dl.from_id, flow=dl.blocks)
 
         # update tau and unchoked_past peers who didn't unchoke me
         others = list(set(chosen)-unchokers)
         for j in others:
-            self.taus[j] *= (1+self.alpha)
-            self.unchoked_past[j] = 0
+            est.set(j, tau=est.tau(j)*(1+self.alpha))
+            est.set_streak(j, 0)
             
         return uploads
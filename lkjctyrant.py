@@ -6,12 +6,11 @@
 # You'll want to copy this file to AgentNameXXX.py for various versions of XXX,
 # probably get rid of the silly logging messages, and then add more logic.
 
-import random
 import logging
 
-from messages import Upload, Request
+from messages import Upload
 from util import even_split
-from peer import Peer
+from peer import Peer, ReciprocationEstimator
 
 class LkjcTyrant(Peer):
     def post_init(self):
@@ -22,9 +21,7 @@ class LkjcTyrant(Peer):
         self.r = 2
         self.alpha = 0.3
         self.cap = self.up_bw
-        self.flows = dict()
-        self.taus = dict()
-        self.unchoked_past = dict()
+        self.estimator = None
     
     def requests(self, peers, history):
         """
@@ -35,62 +32,8 @@ class LkjcTyrant(Peer):
 
         This will be called after update_pieces() with the most recent state.
         """
-        needed = lambda i: self.pieces[i] < self.conf.blocks_per_piece
-        needed_pieces = filter(needed, range(len(self.pieces)))
-        np_set = set(needed_pieces)  # sets support fast intersection ops.
-
-        requests = []   # We'll put all the things we want here
-        # Symmetry breaking is good...
-        random.shuffle(needed_pieces)
-
-        # request all available pieces from all peers!
-        # (up to self.max_requests from each)
-
         # rarest first strategy
-        piece_peers = dict()
-        piece_counts = dict()
-        n_requests = dict()
-
-        for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
-            n_requests[peer.id] = 0
-            # n = min(self.max_requests, len(isect))
-            for piece_id in list(isect):
-                if piece_id not in piece_peers:
-                    piece_peers[piece_id] = [peer.id]
-                    piece_counts[piece_id] = 0
-                else:
-                    piece_peers[piece_id].append(peer.id)
-                    piece_counts[piece_id] += 0
-
-        counts_piece = dict()
-        for piece, count in piece_counts.items():
-            if count in counts_piece:
-                counts_piece[count].append(piece)
-            else:
-                counts_piece[count] = [piece]
-
-        rarest = sorted(counts_piece.items())
-
-
-        for peer in peers:
-            av_set = set(peer.available_pieces)
-            isect = av_set.intersection(np_set)
-            n = min(self.max_requests, len(isect))
-            count = 0
-            while count < n:
-                for c, piece_id_list in rarest:
-                    # eliminate symmetry
-                    random.shuffle(piece_id_list)
-                    for piece_id in piece_id_list:
-                        if piece_id in av_set:
-                            count += 1
-                            start_block = self.pieces[piece_id]
-                            r = Request(self.id, peer.id, piece_id, start_block)
-                            requests.append(r)
-
-        return requests
+        return self.rarest_first_requests(peers)
 
     def uploads(self, requests, peers, history):
         """
@@ -104,8 +47,7 @@ class LkjcTyrant(Peer):
         """
 
         round = history.current_round()
-        logging.debug("%s again.  It's round %d." % (
-            self.id, round))
+        logging.debug("%s again.  It's round %d.", self.id, round)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
@@ -113,73 +55,61 @@ class LkjcTyrant(Peer):
 
          # Initialize f_j and t_j for all peers
         if round == 0:
-            for peer in peers:
-                self.flows[peer.id] = self.up_bw / 4.0
-                self.taus[peer.id] = self.up_bw / 4.0
-                # how many times has this peer unchoked me before?
-                self.unchoked_past[peer.id] = 0
+            self.estimator = ReciprocationEstimator(
+                self.peer_ids, self.peer_index, self.up_bw / 4.0,
+                self.up_bw / 4.0)
+            # peers whose tau or unchoke count isn't the starting one
+            self.changed = set()
         else:
+            est = self.estimator
             # Step 5
             # look at last round downloads
             dl_history = dict()
             for dl in history.downloads[round-1]:
                 if dl.from_id not in dl_history:
                     dl_history[dl.from_id] = dl.blocks
-                    self.unchoked_past[dl.from_id] += 1
+                    est.set_streak(dl.from_id, est.streak(dl.from_id) + 1)
                 else:
                     dl_history[dl.from_id] += dl.blocks
 
-            available_change = set()
-            for peer in peers:
-                if peer.id not in dl_history:
-                    self.unchoked_past[peer.id] = 0
-                    available_change.add(peer.id)
-
             # look at last round uploads
             ul_history = set()
             for ul in history.uploads[round-1]:
                 ul_history.add(ul.to_id)
 
             # update peers who I unchoked last round
-            for peer in list(ul_history):
+            for peer in ul_history:
                 if peer not in dl_history:
-                    self.taus[peer] = self.taus[peer]*(1+self.alpha)
+                    est.set_streak(peer, 0)
+                    est.set(peer, tau=est.tau(peer)*(1+self.alpha))
                 else:
-                    self.flows[peer] = dl_history[peer]
-                    if self.unchoked_past[peer] > self.r:
-                        self.taus[peer] = self.taus[peer]*(1-self.gamma)
-
-            # update taus for peer to back to normal level
-            # if didn't upload to us
-            # so taus don't sky rocket out of control
-            for peer in peers:
-                if peer.id not in ul_history:
-                    if peer.id in available_change:
-                        self.taus[peer.id] = self.cap/4.0
+                    flow = dl_history[peer]
+                    if est.streak(peer) > self.r:
+                        est.set(peer, flow=flow,
+                                tau=est.tau(peer)*(1-self.gamma))
+                    else:
+                        est.set(peer, flow=flow)
+
+            # put taus for peers we didn't trade with either way back to
+            # the normal level, so taus don't sky rocket out of control.
+            # Only the ones changed since then need it.
+            active = ul_history.union(dl_history)
+            for peer in self.changed - active:
+                est.set_streak(peer, 0)
+                est.set(peer, tau=self.cap/4.0)
+            self.changed = active
 
         chosen = []
         bws = []
         if len(requests) == 0:
             logging.debug("No one wants my pieces!")
         else:
-            request_ids = []
-            for request in requests:
-                request_ids.append(request.requester_id)
-
             # step 4
-            # sort peers by decreasing ratio of reciprocation likelihood
-            ratios = dict()
-            for peer in request_ids:
-                ratios[peer] = self.flows[peer]/self.taus[peer]
-
-            # pick uploads
-            ul = 0
-            sorted_peers = sorted(ratios, key=lambda k: ratios[k], reverse=True)
-            for best in sorted_peers:
-                if (ul + self.taus[best]) <= self.cap:
-                    chosen.append(best)
-                    bws.append(self.taus[best])
-                    ul += self.taus[best]
+            # pick peers by decreasing ratio of reciprocation likelihood
+            for (peer_id, bw) in self.estimator.unchoke(
+                    requests.requester_ids, self.cap):
+                chosen.append(peer_id)
+                bws.append(bw)
 
         # create actual uploads out of the list of peer ids and bandwidths
         uploads = [Upload(self.id, peer_id, bw)
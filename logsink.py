@@ -0,0 +1,173 @@
+#!/usr/bin/python
+
+"""
+Log output that doesn't hold up the simulation.
+
+AsyncLogHandler formats each record on the calling thread, then hands the
+text to a background thread through a bounded queue.  The background thread
+writes whatever has piled up in one go.  RotatingFileWriter is a file-like
+sink that can gzip its output and start a new file every so many bytes;
+ClosingStreamHandler writes to one synchronously.
+"""
+
+import os
+import gzip
+import logging
+import threading
+import Queue
+from multiprocessing.util import Finalize
+
+
+class RotatingFileWriter:
+    """
+    A file-like object that writes to path, gzip-compressed if compress is
+    set.  Once max_bytes (uncompressed) have been written to the current
+    file, it's renamed to path.1, path.1 to path.2, and so on up to
+    path.<backups>, and a new file is started.  max_bytes=0 never rotates.
+
+    A forked child process that writes switches to its own file,
+    path.pid<N>, rather than interleaving with the parent, and closes it
+    when a multiprocessing worker exits.
+    """
+    def __init__(self, path, max_bytes=0, backups=5, compress=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.written = 0
+        self.pid = os.getpid()
+        self.f = self.open()
+
+    def open(self):
+        if self.compress:
+            return gzip.open(self.path, "wb")
+        return open(self.path, "w")
+
+    def rotate(self):
+        self.f.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                src = "%s.%d" % (self.path, i)
+                if os.path.exists(src):
+                    os.rename(src, "%s.%d" % (self.path, i + 1))
+            os.rename(self.path, self.path + ".1")
+        self.f = self.open()
+        self.written = 0
+
+    def write(self, s):
+        if os.getpid() != self.pid:
+            # Leave the parent's file alone (it's flushed before forking).
+            # Keep a reference so it never gets closed from this process.
+            self.inherited = self.f
+            self.pid = os.getpid()
+            self.path = "%s.pid%d" % (self.path, self.pid)
+            self.f = self.open()
+            self.written = 0
+            Finalize(self, self.close, exitpriority=10)
+        self.f.write(s)
+        self.written += len(s)
+        if self.max_bytes > 0 and self.written >= self.max_bytes:
+            self.rotate()
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class ClosingStreamHandler(logging.StreamHandler):
+    """
+    A StreamHandler that closes its stream when it's closed, for a stream
+    it owns, like a RotatingFileWriter.  (A gzipped log is only complete
+    once its writer is closed.)  logging closes handlers at exit.
+    """
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.flush()
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        logging.StreamHandler.close(self)
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    A logging handler that queues formatted records for a background writer
+    thread.  When the queue (queue_size records) is full, logging blocks
+    until the writer catches up, so memory stays bounded.  The writer takes
+    up to batch_size records at a time and writes them with one call.
+
+    flush() waits until everything queued so far has been written.  The
+    writer thread is restarted if the handler finds itself in a forked
+    child process, and drained when a multiprocessing worker exits.
+    """
+    def __init__(self, stream, queue_size=10000, batch_size=512,
+                 close_stream=False):
+        """
+        stream: anything with write() and flush()
+        close_stream: whether close() should close the stream too
+        """
+        logging.Handler.__init__(self)
+        self.stream = stream
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.close_stream = close_stream
+        self.start()
+
+    def start(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(self.queue_size)
+        self.thread = threading.Thread(target=self.run, name="log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        q = self.queue
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except Queue.Empty:
+                    break
+            done = None in batch
+            text = "".join(s for s in batch if s is not None)
+            try:
+                if text:
+                    self.stream.write(text)
+                    self.stream.flush()
+            finally:
+                for _ in batch:
+                    q.task_done()
+            if done:
+                return
+
+    def emit(self, record):
+        try:
+            # Format now: the arguments may refer to state that changes.
+            msg = self.format(record) + "\n"
+            if os.getpid() != self.pid:
+                self.start()
+                # Runs before the RotatingFileWriter's finalizer
+                Finalize(self, self.close, exitpriority=20)
+            self.queue.put(msg)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def flush(self):
+        if os.getpid() == self.pid and self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if os.getpid() == self.pid and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.close_stream:
+            self.stream.close()
+        logging.Handler.close(self)
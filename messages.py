@@ -1,6 +1,14 @@
 #!/usr/bin/python
 
-class Upload:
+import itertools
+from array import array
+
+# Tens of thousands of these get made every round, and Downloads are kept
+# in the History, so they use __slots__ instead of a per-instance __dict__.
+
+class Upload(object):
+    __slots__ = ("from_id", "to_id", "bw")
+
     def __init__(self, from_id, to_id, up_bw):
         self.from_id = from_id
         self.to_id = to_id
@@ -10,7 +18,9 @@ class Upload:
         return "Upload(from_id = %s, to_id=%s, bw=%d)" % (
             self.from_id, self.to_id, self.bw)
 
-class Request:
+class Request(object):
+    __slots__ = ("requester_id", "peer_id", "piece_id", "start")
+
     def __init__(self, requester_id, peer_id, piece_id, start):
         self.requester_id = requester_id
         self.peer_id = peer_id   # peer data is requested from
@@ -21,10 +31,34 @@ class Request:
         return "Request(requester_id=%s, peer_id=%s, piece_id=%d, start=%d)" % (
             self.requester_id, self.peer_id, self.piece_id, self.start)
 
-class Download:
+class RequestInbox(list):
+    """
+    The requests sent to one peer in a round.  It's a list of Request
+    objects, plus requester_ids: a list of the ids of the peers that sent
+    them, without duplicates, in the order they first appear.
+    """
+    __slots__ = ("requester_ids", "_seen")
+
+    def __init__(self, requests=()):
+        list.__init__(self)
+        self.requester_ids = []
+        self._seen = set()
+        for r in requests:
+            self.add(r)
+
+    def add(self, request):
+        """Append a request.  Requests may come in any order."""
+        self.append(request)
+        if request.requester_id not in self._seen:
+            self._seen.add(request.requester_id)
+            self.requester_ids.append(request.requester_id)
+
+class Download(object):
     """ Not actually a message--just used for accounting and history tracking of
      what is actually downloaded.
     """
+    __slots__ = ("from_id", "to_id", "piece", "blocks")
+
     def __init__(self, from_id, to_id, piece, blocks):
         self.from_id = from_id  # who did the agent download from?
         self.to_id = to_id      # Who downloaded?
@@ -36,17 +70,214 @@ class Download:
             self.from_id, self.to_id, self.piece, self.blocks)
 
 
-
-            
-class PeerInfo:
+class PeerInfo(object):
     """
     Only passing peer ids and the pieces they have available to each agent.
     This prevents them from accidentally messing up the state of other agents.
+
+    available_pieces is a frozenset snapshot, and PeerInfo objects can't be
+    changed once made, so the sim can share them between agents.  Like
+    the old class, two PeerInfo objects are equal only if they're the same
+    object.
     """
+    __slots__ = ("id", "available_pieces")
+
     def __init__(self, id, available):
-        self.id = id
-        self.available_pieces = available
+        object.__setattr__(self, "id", id)
+        object.__setattr__(self, "available_pieces", frozenset(available))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PeerInfo is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("PeerInfo is read-only")
+
+    # Copying and pickling would restore the slots with setattr, so go
+    # through the constructor instead.  Copies can be the object itself,
+    # since it never changes.
+    def __reduce__(self):
+        return (PeerInfo, (self.id, self.available_pieces))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __repr__(self):
         return "PeerInfo(id=%s)" % self.id
 
+
+class PeerView(object):
+    """
+    The peers one agent sees in a round: a shared tuple of PeerInfo
+    snapshots, with the agent's own entry skipped.  Reads like a list
+    (len, iteration, indexing, slicing) without copying the tuple.
+
+    version: the round the snapshots were taken in.
+    """
+    __slots__ = ("_infos", "_skip", "version")
+
+    def __init__(self, infos, skip, version):
+        """
+        infos: tuple of PeerInfo, shared by all the views for a round
+        skip: index in infos of the agent's own entry
+        """
+        self._infos = infos
+        self._skip = skip
+        self.version = version
+
+    def __len__(self):
+        return len(self._infos) - 1
+
+    def __iter__(self):
+        infos = self._infos
+        return itertools.chain(itertools.islice(infos, 0, self._skip),
+                               itertools.islice(infos, self._skip + 1, None))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("PeerView index out of range")
+        if i >= self._skip:
+            i += 1
+        return self._infos[i]
+
+    def __repr__(self):
+        return "PeerView(%s)" % list(self)
+
+
+
+class RequestBatch(object):
+    """
+    One peer's requests for a round in columnar form, for agents with
+    batch_protocol set (see Peer).  Parallel arrays, one entry per request:
+
+      peers:  index of the peer asked (see Peer.update_index)
+      pieces: piece id
+      starts: start block, and starts_int: whether it's an int.  Starts are
+              doubles because a peer can have fractional blocks.
+
+    Iterating gives the equivalent Request objects.
+    """
+    __slots__ = ("requester_id", "peer_ids", "peers", "pieces", "starts",
+                 "starts_int", "_objects")
+
+    def __init__(self, requester_id, peer_ids):
+        """
+        peer_ids: list of peer ids in index order, to turn indexes back
+            into ids (Peer.peer_ids)
+        """
+        self.requester_id = requester_id
+        self.peer_ids = peer_ids
+        self.peers = array('i')
+        self.pieces = array('i')
+        self.starts = array('d')
+        self.starts_int = array('b')
+        self._objects = None
+
+    @classmethod
+    def from_requests(cls, requester_id, peer_ids, index, requests):
+        """
+        Adapter for agents that return a list of Request objects.  index:
+        dict peer_id -> peer index.  Keeps the list, so iterating the batch
+        gives back the same objects.
+        """
+        batch = cls(requester_id, peer_ids)
+        for r in requests:
+            batch.add(index[r.peer_id], r.piece_id, r.start)
+        batch._objects = requests
+        return batch
+
+    def add(self, peer_index, piece_id, start):
+        self.peers.append(peer_index)
+        self.pieces.append(piece_id)
+        self.starts.append(start)
+        self.starts_int.append(isinstance(start, (int, long)))
+        self._objects = None
+
+    def start(self, k):
+        """The start block of request k, as the agent gave it."""
+        s = self.starts[k]
+        return int(s) if self.starts_int[k] else s
+
+    def request(self, k):
+        return Request(self.requester_id, self.peer_ids[self.peers[k]],
+                       self.pieces[k], self.start(k))
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __iter__(self):
+        if self._objects is None:
+            self._objects = [self.request(k) for k in xrange(len(self))]
+        return iter(self._objects)
+
+    def __repr__(self):
+        return "RequestBatch(%s)" % list(self)
+
+
+class UploadBatch(object):
+    """
+    One peer's uploads for a round in columnar form, for agents with
+    batch_protocol set.  Parallel arrays, one entry per upload:
+
+      peers: index of the peer uploaded to.  -1 for an id that isn't a
+             peer, which only the adapter makes, from Upload objects.
+      bws:   bandwidth, and bws_int: whether it's an int
+
+    Iterating gives the equivalent Upload objects.
+    """
+    __slots__ = ("from_id", "peer_ids", "peers", "bws", "bws_int", "_objects")
+
+    def __init__(self, from_id, peer_ids):
+        self.from_id = from_id
+        self.peer_ids = peer_ids
+        self.peers = array('i')
+        self.bws = array('d')
+        self.bws_int = array('b')
+        self._objects = None
+
+    @classmethod
+    def from_uploads(cls, from_id, peer_ids, index, uploads):
+        """Adapter for agents that return a list of Upload objects."""
+        batch = cls(from_id, peer_ids)
+        for u in uploads:
+            batch.add(index.get(u.to_id, -1), u.bw)
+        batch._objects = uploads
+        return batch
+
+    def add(self, peer_index, bw):
+        self.peers.append(peer_index)
+        self.bws.append(bw)
+        self.bws_int.append(isinstance(bw, (int, long)))
+        self._objects = None
+
+    def bw(self, k):
+        """The bandwidth of upload k, as the agent gave it."""
+        b = self.bws[k]
+        return int(b) if self.bws_int[k] else b
+
+    def upload(self, k):
+        return Upload(self.from_id, self.peer_ids[self.peers[k]], self.bw(k))
+
+    def rate_to(self, peer_index):
+        """Bandwidth of the first upload to peer_index, or 0 if none."""
+        try:
+            return self.bw(self.peers.index(peer_index))
+        except ValueError:
+            return 0
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __iter__(self):
+        if self._objects is None:
+            self._objects = [self.upload(k) for k in xrange(len(self))]
+        return iter(self._objects)
+
+    def __repr__(self):
+        return "UploadBatch(%s)" % list(self)
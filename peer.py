@@ -1,13 +1,189 @@
 #!/usr/bin/python
 
+import heapq
 import random
+from array import array
+from bisect import bisect_left, insort
 from messages import Upload, Request
 from util import even_split
 
+
+class PieceSelector:
+    """
+    Rarest-first piece choice for an agent, kept up to date between rounds
+    instead of re-sorting every needed piece each round.
+
+    The pieces the agent still needs are kept in order of (holder count,
+    random tie-break).  Each round, update() drops the pieces the agent has
+    finished and moves the ones whose holder count went up (as the sim's
+    RarityView reports them).  Each move is a bisect in a list that's
+    already in order.  That's the same order a heap would give, but it can
+    be read front to back without popping everything off.
+
+    Ties between pieces with the same count are broken at random when a
+    piece gets its count, and stay that way until the count changes.
+    """
+    def __init__(self, rarity, num_pieces, blocks_per_piece, rng=random):
+        self.rarity = rarity
+        self.blocks_per_piece = blocks_per_piece
+        self.rng = rng
+        self.version = rarity.version()
+        self.key = dict()   # needed piece -> (count, tie-break, piece)
+        for piece_id in range(num_pieces):
+            self.key[piece_id] = (rarity.count(piece_id), rng.random(),
+                                  piece_id)
+        self.order = sorted(self.key.values())
+
+    def remove(self, piece_id):
+        k = self.key.pop(piece_id)
+        del self.order[bisect_left(self.order, k)]
+
+    def update(self, pieces):
+        """
+        Catch up with the swarm and with pieces, the agent's block counts
+        per piece.
+        """
+        bpp = self.blocks_per_piece
+        for piece_id in [p for p in self.key if pieces[p] >= bpp]:
+            self.remove(piece_id)
+
+        changed = set(self.rarity.changed_since(self.version))
+        self.version = self.rarity.version()
+        for piece_id in changed:
+            if piece_id in self.key:
+                self.remove(piece_id)
+                k = (self.rarity.count(piece_id), self.rng.random(), piece_id)
+                self.key[piece_id] = k
+                insort(self.order, k)
+
+    def needed(self):
+        """The pieces still needed, rarest first."""
+        return [p for (c, t, p) in self.order]
+
+    def choose(self, available, n):
+        """
+        Return up to n of the needed pieces in available (a set of piece
+        ids, say a peer's available_pieces), rarest first.
+        """
+        if len(available) < len(self.order):
+            # Cheaper to rank the peer's pieces than to scan ours
+            keys = [self.key[p] for p in available if p in self.key]
+            return [p for (c, t, p) in heapq.nsmallest(n, keys)]
+        ans = []
+        if n <= 0:
+            return ans
+        for (c, t, p) in self.order:
+            if p in available:
+                ans.append(p)
+                if len(ans) == n:
+                    break
+        return ans
+
+
+class ReciprocationEstimator:
+    """
+    BitTyrant-style estimates of each peer's upload flow to us (f) and the
+    upload rate it takes to be reciprocated by it (tau), for agents that
+    unchoke the peers with the best f/tau first.
+
+    flows, taus: arrays of doubles, by peer index (see Peer.update_index)
+    streaks: array of ints, by peer index: rounds in a row the peer has
+        unchoked us.  The agent keeps these up to date.
+
+    The peers are kept in order of decreasing f/tau (ties by index), and
+    set() moves just the peer that changed, so each round costs the number
+    of estimates that changed times a bisect, not a sort of every peer.
+    """
+    def __init__(self, peer_ids, peer_index, flow, tau):
+        """
+        peer_ids, peer_index: as given to Peer.update_index
+        flow, tau: starting estimates for every peer
+        """
+        self.peer_ids = peer_ids
+        self.peer_index = peer_index
+        n = len(peer_ids)
+        self.flows = array('d', [flow]) * n
+        self.taus = array('d', [tau]) * n
+        self.streaks = array('i', [0]) * n
+        self.order = [(-self.ratio_at(i), i) for i in range(n)]
+        self.order.sort()
+
+    def ratio_at(self, i):
+        return self.flows[i] / self.taus[i]
+
+    def flow(self, peer_id):
+        return self.flows[self.peer_index[peer_id]]
+
+    def tau(self, peer_id):
+        return self.taus[self.peer_index[peer_id]]
+
+    def streak(self, peer_id):
+        return self.streaks[self.peer_index[peer_id]]
+
+    def set_streak(self, peer_id, n):
+        self.streaks[self.peer_index[peer_id]] = n
+
+    def set(self, peer_id, flow=None, tau=None):
+        """Change peer_id's flow and/or tau estimate."""
+        i = self.peer_index[peer_id]
+        old = (-self.ratio_at(i), i)
+        if flow is not None:
+            self.flows[i] = flow
+        if tau is not None:
+            self.taus[i] = tau
+        new = (-self.ratio_at(i), i)
+        if new != old:
+            del self.order[bisect_left(self.order, old)]
+            insort(self.order, new)
+
+    def ranked(self, candidates):
+        """
+        Return the peer ids in candidates (a collection of ids), best f/tau
+        first.  Walks the ordering only until every candidate is found.
+        """
+        index = self.peer_index
+        wanted = set(index[pid] for pid in candidates)
+        ans = []
+        ids = self.peer_ids
+        for (r, i) in self.order:
+            if i in wanted:
+                ans.append(ids[i])
+                if len(ans) == len(wanted):
+                    break
+        return ans
+
+    def unchoke(self, candidates, cap):
+        """
+        Greedily pick peers from candidates, best f/tau first, giving each
+        its tau, as long as the total stays within cap.  Returns a list of
+        (peer_id, tau) pairs.
+        """
+        ans = []
+        ul = 0
+        for pid in self.ranked(candidates):
+            tau = self.tau(pid)
+            if ul + tau <= cap:
+                ans.append((pid, tau))
+                ul += tau
+        return ans
+
+
 class Peer:
-    def __init__(self, config, id, init_pieces, up_bandwidth):
+    # Agents that set this return a messages.RequestBatch from requests()
+    # and a messages.UploadBatch from uploads() instead of lists of Request
+    # and Upload objects.  The sim can check and apply those in bulk.
+    batch_protocol = False
+
+    def __init__(self, config, id, init_pieces, up_bandwidth, rng=None):
         self.conf = config
         self.id = id
+        # This peer's own random.Random.  The sim gives each peer a stream
+        # seeded from the run's seed and the peer id, so a peer's choices
+        # don't depend on what the others draw.  Use it instead of the
+        # random module, and don't reseed it.
+        if rng is None:
+            rng = random.Random()
+        self.rng = rng
         self.pieces = init_pieces[:]
         # bandwidth measured in blocks-per-time-period
         self.up_bw = up_bandwidth
@@ -17,6 +193,15 @@ class Peer:
         self.max_requests = self.conf.max_up_bw / self.conf.blocks_per_piece + 1
         self.max_requests = min(self.max_requests, self.conf.num_pieces)
 
+        # Read-only swarm.RarityView, set by the sim before the first round
+        self.rarity = None
+        # PieceSelector over it, made when the RarityView arrives
+        self.selector = None
+        # Peer ids in index order and dict peer_id -> index, set by the sim
+        # before the first round.  Shared between agents: don't change them.
+        self.peer_ids = None
+        self.peer_index = None
+
         self.post_init()
 
     def __repr__(self):
@@ -31,6 +216,42 @@ class Peer:
         """
         self.pieces = new_pieces
 
+    def update_rarity(self, rarity):
+        """
+        Called by the sim once, before the first round, with a read-only
+        view of how many peers have each piece.  The view stays current, so
+        there's no need to rebuild piece counts from the peer list.
+        """
+        self.rarity = rarity
+        self.selector = PieceSelector(rarity, self.conf.num_pieces,
+                                      self.conf.blocks_per_piece, self.rng)
+
+    def rarest_first_requests(self, peers):
+        """
+        Return a list of Requests: from each peer in peers, in order, for
+        the rarest pieces it has that we still need, up to
+        self.max_requests, by the sim's swarm-wide piece counts.  Ties are
+        broken at random.
+        """
+        self.selector.update(self.pieces)
+        requests = []
+        for peer in peers:
+            for piece_id in self.selector.choose(peer.available_pieces,
+                                                 self.max_requests):
+                start_block = self.pieces[piece_id]
+                requests.append(Request(self.id, peer.id, piece_id,
+                                        start_block))
+        return requests
+
+    def update_index(self, peer_ids, peer_index):
+        """
+        Called by the sim once, before the first round, with the peer ids
+        in index order and a dict from peer id to index.  Batches refer to
+        peers by these indexes.
+        """
+        self.peer_ids = peer_ids
+        self.peer_index = peer_index
+
     def requests(self, peers, history):
         return []
 
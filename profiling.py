@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+"""
+Timing for the simulator's phases and agents.  The sim only uses a timer
+when one is set on it, by re-binding its helpers to timed versions, so
+untimed runs don't pay anything.
+
+PhaseTimer keeps total wall time per phase; bench.py uses it.  CallProfile
+(sim.py --profile) also keeps every call's time, for percentiles, counts
+allocations, and times each agent class's requests() and uploads().
+"""
+
+import gc
+import math
+import time
+from array import array
+
+
+class PhaseTimer:
+    """
+    Wall time spent in each phase of a run.  wrap(phase, f) returns f timed
+    under phase.  Phases can nest: what's used in an inner phase isn't
+    counted in the outer one, so the totals add up to the time spent in
+    wrapped calls.
+
+    totals: dict phase -> seconds
+    calls:  dict phase -> number of calls
+    """
+    # Whether the sim should time agents' requests() and uploads() too
+    by_agent = False
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.totals = dict()
+        self.calls = dict()
+        self.stack = []   # what inner phases used, per open call
+
+    def measure(self):
+        """What's counted for a call, as a tuple: measured before and after
+        the call, and the differences passed to record()."""
+        return (self.clock(),)
+
+    def record(self, phase, used):
+        """used: the measure() differences for one call of phase, less
+        what inner phases used."""
+        self.add(phase, used[0])
+
+    def add(self, phase, seconds):
+        self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    def wrap(self, phase, f):
+        measure = self.measure
+        stack = self.stack
+        def timed(*args, **kwargs):
+            stack.append(None)
+            before = measure()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                total = [a - b for (a, b) in zip(measure(), before)]
+                inner = stack.pop()
+                if inner is None:
+                    self.record(phase, total)
+                else:
+                    self.record(phase, [t - i for (t, i) in zip(total, inner)])
+                if stack:
+                    outer = stack[-1]
+                    if outer is None:
+                        stack[-1] = total
+                    else:
+                        stack[-1] = [o + t for (o, t) in zip(outer, total)]
+        return timed
+
+    def total(self):
+        return sum(self.totals.values())
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a sorted sequence, q between 0 and 1."""
+    if len(values) == 0:
+        return 0.0
+    k = max(0, int(math.ceil(q * len(values))) - 1)
+    return values[k]
+
+
+class CallProfile(PhaseTimer):
+    """
+    A PhaseTimer that also keeps
+
+      samples: dict phase -> array of each call's seconds
+      allocs:  dict phase -> net new objects tracked by the garbage
+               collector (lists, dicts, instances, ...)
+
+    Python 2 has no tracemalloc, so allocations are counted with
+    gc.get_count().  That's only exact while automatic collection is off,
+    so start() turns it off and the profile runs the collections itself,
+    between top-level calls.  stop() turns it back on.
+
+    Agents' calls are recorded under "<class name>.requests" and
+    "<class name>.uploads".
+    """
+    by_agent = True
+
+    def __init__(self, clock=time.time):
+        PhaseTimer.__init__(self, clock)
+        self.samples = dict()
+        self.allocs = dict()
+        self.gc_was_enabled = None
+
+    def start(self):
+        self.gc_was_enabled = gc.isenabled()
+        gc.disable()
+
+    def stop(self):
+        if self.gc_was_enabled:
+            gc.enable()
+
+    def collect(self):
+        """Collect the generations automatic collection would have."""
+        counts = gc.get_count()
+        thresholds = gc.get_threshold()
+        gen = -1
+        for g in range(3):
+            if thresholds[g] > 0 and counts[g] > thresholds[g]:
+                gen = g
+            else:
+                break
+        if gen >= 0:
+            gc.collect(gen)
+
+    def measure(self):
+        return (self.clock(), gc.get_count()[0])
+
+    def record(self, phase, used):
+        (seconds, allocs) = used
+        self.add(phase, seconds)
+        if phase not in self.samples:
+            self.samples[phase] = array('d')
+        self.samples[phase].append(seconds)
+        self.allocs[phase] = self.allocs.get(phase, 0) + allocs
+
+    def wrap(self, phase, f):
+        timed = PhaseTimer.wrap(self, phase, f)
+        stack = self.stack
+        def profiled(*args, **kwargs):
+            if not stack and self.gc_was_enabled:
+                self.collect()
+            return timed(*args, **kwargs)
+        return profiled
+
+    def merge(self, other):
+        """Add in another CallProfile's numbers, e.g. from another run."""
+        for (phase, seconds) in other.totals.items():
+            self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+            self.calls[phase] = self.calls.get(phase, 0) + other.calls[phase]
+            if phase not in self.samples:
+                self.samples[phase] = array('d')
+            self.samples[phase].extend(other.samples[phase])
+            self.allocs[phase] = self.allocs.get(phase, 0) + other.allocs[phase]
+
+    def __getstate__(self):
+        # Sent back from worker processes; the clock and stack stay behind
+        state = self.__dict__.copy()
+        del state["clock"]
+        state["stack"] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clock = time.time
+
+    def report(self):
+        """
+        Return a list of report lines, one per phase or agent method, most
+        total time first.
+        """
+        total = self.total() or 1.0
+        lines = ["%-28s %8s %10s %6s %10s %10s %10s" % (
+            "phase", "calls", "total s", "share", "p50 ms", "p99 ms",
+            "allocs/call")]
+        for phase in sorted(self.totals, key=self.totals.get, reverse=True):
+            samples = sorted(self.samples[phase])
+            calls = self.calls[phase]
+            lines.append("%-28s %8d %10.3f %5.1f%% %10.3f %10.3f %10.1f" % (
+                phase, calls, self.totals[phase],
+                100.0 * self.totals[phase] / total,
+                1000 * percentile(samples, 0.5),
+                1000 * percentile(samples, 0.99),
+                float(self.allocs[phase]) / calls))
+        return lines
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+"""
+Recompute stats from event traces written by sim.py --trace, without
+running the simulation again.  Each trace's History is rebuilt and the
+usual per-run stats and summary are logged.
+"""
+
+import sys
+import logging
+from optparse import OptionParser
+
+from eventtrace import replay
+from stats import Stats, IterationSummary
+from sim import configure_logging, log_run_stats, log_summary
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options] TRACE1 [TRACE2 ...]"
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--loglevel",
+                      dest="loglevel", default="warning",
+                      help="Set the logging level: 'info' shows each run's stats")
+
+    (options, paths) = parser.parse_args(args[1:])
+    if len(paths) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    configure_logging(options.loglevel)
+
+    summary = None
+    for path in paths:
+        history = replay(path)
+        peer_ids = history.peer_ids
+        logging.info("Replayed %s: %d rounds", path, history.num_rounds)
+        log_run_stats(peer_ids, history)
+
+        if summary is None:
+            summary = IterationSummary(peer_ids)
+        summary.add(Stats.uploaded_blocks(peer_ids, history),
+                    Stats.completion_rounds(peer_ids, history))
+
+    log_summary(summary)
+
+if __name__ == "__main__":
+    main(sys.argv)
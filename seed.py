@@ -1,24 +1,26 @@
 #!/usr/bin/python
 
-import random
-from messages import Upload, Request
+from messages import RequestBatch, UploadBatch
 from util import even_split
 from peer import Peer
 
 class Seed(Peer):
+    batch_protocol = True
+
     def requests(self, peers, history):
         # Seeds don't need anything.
-        return []
+        return RequestBatch(self.id, self.peer_ids)
 
     def uploads(self, requests, peers, history):
         max_upload = 4  # max num of peers to upload to at a time
-        requester_ids = list(set(map(lambda r: r.requester_id, requests)))
+        requester_ids = requests.requester_ids
 
+        uploads = UploadBatch(self.id, self.peer_ids)
         n = min(max_upload, len(requester_ids))
         if n == 0:
-            return []
+            return uploads
         bws = even_split(self.up_bw, n)
-        uploads = [Upload(self.id, p_id, bw)
-                   for (p_id, bw) in zip(random.sample(requester_ids, n), bws)]
-        
+        for (p_id, bw) in zip(self.rng.sample(requester_ids, n), bws):
+            uploads.add(self.peer_index[p_id], bw)
+
         return uploads
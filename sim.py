@@ -8,6 +8,7 @@ Simulates one file being shared amongst a set of peers.  The file is divided int
 The simulation proceeds in rounds.  In each round, peers can request pieces from other peers, and then decide how much to upload to others.  Once every peer has every piece, the simulation ends.
 """
 
+import os
 import re
 import random
 import sys
@@ -15,18 +16,40 @@ import logging
 import copy
 import itertools
 import pprint
+import tempfile
+import multiprocessing
 from optparse import OptionParser
 
-from messages import Upload, Request, Download, PeerInfo
+from messages import Upload, Request, Download, PeerInfo, PeerView, RequestInbox
+from messages import RequestBatch, UploadBatch
 from util import *
-from stats import Stats
-from history import History
+from stats import Stats, IterationSummary
+from history import History, SpillingHistory
+from swarm import SwarmState, PieceCounts
+from logsink import AsyncLogHandler, ClosingStreamHandler
+from logsink import RotatingFileWriter
+from eventtrace import TraceWriter
+from profiling import CallProfile
+from timelimit import call_with_limit, CallTimeout
+from cache import ResultCache, result_key, source_digest
+from transfer import resolve_transfers, sort_positions
     
 
 class Sim:
-    def __init__(self, config):
+    def __init__(self, config, seed=0):
         self.config = config
+        # Every random choice in a run comes from a random.Random stream
+        # derived from this seed: one per peer, and one per peer's
+        # bandwidth.  A run depends only on the seed, not on what else ran
+        # in the process before it.
+        self.seed = seed
+        # How a round's uploads turn into blocks; bench.py --check swaps in
+        # a version that compares against the reference one
+        self.resolve_transfers = resolve_transfers
         self.up_bws_state = dict()
+        self.iteration = 0   # which of the config.iters runs this is
+        self.timer = None    # profiling.PhaseTimer, to time each phase
+        self.overruns = dict()   # peer_id -> calls over the time budget
 
     
     def up_bw(self, peer_id, reinit=False):
@@ -37,12 +60,23 @@ class Sim:
         # Re-initialize up-bws if we are starting a new simulation
         if reinit and peer_id in s:
             del s[peer_id]
+
+        if peer_id in s:
+            return s[peer_id]
         
         """Sets the upload bandwidth of seeds to max, other agents at random"""
         if re.match("Seed",peer_id): the_up_bw = c.max_up_bw
-        else: the_up_bw = random.randint(c.min_up_bw, c.max_up_bw)
+        else:
+            rng = self.rng("up_bw", peer_id)
+            the_up_bw = rng.randint(c.min_up_bw, c.max_up_bw)
         
-        return s.setdefault(peer_id, the_up_bw)
+        s[peer_id] = the_up_bw
+        return the_up_bw
+
+    def rng(self, *labels):
+        """A random.Random of its own for the part of the run named by
+        labels, seeded from the run's seed."""
+        return random.Random(derive_seed(self.seed, *labels))
 
     def run_sim_once(self):
         """Return a history"""
@@ -50,33 +84,60 @@ class Sim:
         # Keep track of the current round.  Needs to be in scope for helpers.
         round = 0  
 
-        def check_pred(pred, msg, Exc, lst):
-            """Check if any element of lst matches the predicate.  If it does,
-            raise an exception of type Exc, including the msg and the offending
-            element."""
-            m = map(pred, lst)
-            if True in m:
-                i = m.index(True)
-                raise Exc(msg + " Bad element: %s" % lst[i])
+        def check_all(checks, Exc, lst, describe=None):
+            """
+            checks: list of (pred, msg) pairs, most important first.
+            describe: if given, applied to the offending element for the
+                error message
+
+            Check every element of lst against the predicates in one pass.
+            If any element matches a predicate, raise an exception of type
+            Exc for the first check in the list that matched, including the
+            msg and the first offending element.  That's the same error as
+            running each check over the whole list in turn.
+            """
+            n = len(checks)   # only checks before this one still matter
+            bad = None
+            for x in lst:
+                for k in range(n):
+                    if checks[k][0](x):
+                        n = k
+                        bad = x
+                        break
+                if n == 0:
+                    break
+            if n < len(checks):
+                if describe is not None:
+                    bad = describe(bad)
+                raise Exc(checks[n][1] + " Bad element: %s" % bad)
+
+        def should_check(peer):
+            """
+            Whether to validate this peer's requests and uploads this round.
+            'sampled' checks each peer once every conf.validate_every
+            rounds, staggered so that some peers get checked every round.
+            """
+            if conf.validate == "strict":
+                return True
+            if conf.validate == "off":
+                return False
+            return (round + self.peer_index[peer.id]) % conf.validate_every == 0
 
         def check_uploads(peer, uploads):
             """Raise an IllegalUpload exception if there is a problem."""
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalUpload, uploads)
-
-            not_upload = lambda o: not isinstance(o, Upload)
-            check(not_upload, "List of Uploads contains non-Upload object.")
-
-            self_upload = lambda upload: upload.to_id == peer.id
-            check(self_upload, "Can't upload to yourself.")
-            
-            not_from_self = lambda upload: upload.from_id != peer.id
-            check(not_from_self, "Upload.from != peer id.")
-
-            check(lambda u: u.bw < 0, "Upload bandwidth must be non-negative!")
-
-            limit = self.up_bw(peer.id)
-            if sum(map(lambda u: u.bw, uploads)) > limit:
+            checks = [
+                (lambda o: not isinstance(o, Upload),
+                 "List of Uploads contains non-Upload object."),
+                (lambda u: u.to_id == peer.id,
+                 "Can't upload to yourself."),
+                (lambda u: u.from_id != peer.id,
+                 "Upload.from != peer id."),
+                (lambda u: u.bw < 0,
+                 "Upload bandwidth must be non-negative!")]
+            check_all(checks, IllegalUpload, uploads)
+
+            limit = self.up_bws_state[peer.id]
+            if sum(u.bw for u in uploads) > limit:
                 raise IllegalUpload("Can't upload more than limit of %d. %s" % (
                     limit, uploads))
 
@@ -84,42 +145,103 @@ class Sim:
 
         def check_requests(peer, requests, peer_pieces, available):
             """Raise an IllegalRequest exception if there is a problem."""
-
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalRequest, requests)
-
-            check(lambda o: not isinstance(o, Request),
-                  "List of Requests contains non-Request object.")
-
-            bad_piece_id = lambda r: (r.piece_id < 0 or
-                                      r.piece_id >= self.config.num_pieces)
-            check(bad_piece_id, "Request asks for non-existent piece!")
-            
-            bad_peer_id = lambda r: r.peer_id not in self.peer_ids
-            check(bad_peer_id, "Request mentions non-existent peer!")
-
-            bad_requester_id = lambda r: r.requester_id != peer.id
-            check(bad_requester_id, "Request has wrong peer id!")
-
-            bad_start_block = lambda r: (
-                r.start < 0 or
-                r.start >= self.config.blocks_per_piece or
-                r.start > peer_pieces[peer.id][r.piece_id])
-            # Must request the _next_ necessary block
-            check(bad_start_block, "Request has bad start block!")
-
-            def piece_peer_does_not_have(r):
-                other_peer = self.peers_by_id[r.peer_id]
-                return r.piece_id not in available[other_peer.id]
-            check(piece_peer_does_not_have, "Asking for piece peer does not have!")
+            num_pieces = conf.num_pieces
+            bpp = conf.blocks_per_piece
+            my_pieces = peer_pieces[peer.id]
+
+            checks = [
+                (lambda o: not isinstance(o, Request),
+                 "List of Requests contains non-Request object."),
+                (lambda r: r.piece_id < 0 or r.piece_id >= num_pieces,
+                 "Request asks for non-existent piece!"),
+                (lambda r: r.peer_id not in available,
+                 "Request mentions non-existent peer!"),
+                (lambda r: r.requester_id != peer.id,
+                 "Request has wrong peer id!"),
+                # Must request the _next_ necessary block
+                (lambda r: (r.start < 0 or r.start >= bpp or
+                            r.start > my_pieces[r.piece_id]),
+                 "Request has bad start block!"),
+                (lambda r: r.piece_id not in available[r.peer_id],
+                 "Asking for piece peer does not have!")]
+            check_all(checks, IllegalRequest, requests)
             
             # If we got here, looks ok
 
+        def check_upload_batch(peer, batch):
+            """
+            Raise an IllegalUpload exception if there is a problem with an
+            UploadBatch.  Whole columns are checked at once; rows are only
+            looked at one by one to report a problem.
+            """
+            if not isinstance(batch, UploadBatch):
+                raise IllegalUpload("Batch agent must return an UploadBatch.")
+            if batch.from_id != peer.id:
+                raise IllegalUpload("Upload.from != peer id.")
+            if len(batch) == 0:
+                return
+            n = len(self.peer_ids)
+            me = self.peer_index[peer.id]
+            peers = batch.peers
+            if min(peers) < 0 or max(peers) >= n or me in peers:
+                checks = [
+                    (lambda k: peers[k] == me, "Can't upload to yourself."),
+                    (lambda k: peers[k] < 0 or peers[k] >= n,
+                     "Upload to non-existent peer!")]
+                check_all(checks, IllegalUpload, xrange(len(batch)),
+                          batch.upload)
+            if min(batch.bws) < 0:
+                raise IllegalUpload("Upload bandwidth must be non-negative!")
+
+            limit = self.up_bws_state[peer.id]
+            if sum(batch.bws) > limit:
+                raise IllegalUpload("Can't upload more than limit of %d. %s" % (
+                    limit, batch))
+
+        def check_request_batch(peer, batch, peer_pieces, available):
+            """
+            Raise an IllegalRequest exception if there is a problem with a
+            RequestBatch.  The same checks as check_requests, with the piece
+            and peer ranges checked a column at a time.
+            """
+            if not isinstance(batch, RequestBatch):
+                raise IllegalRequest("Batch agent must return a RequestBatch.")
+            if batch.requester_id != peer.id:
+                raise IllegalRequest("Request has wrong peer id!")
+            if len(batch) == 0:
+                return
+            num_pieces = conf.num_pieces
+            bpp = conf.blocks_per_piece
+            n = len(self.peer_ids)
+            my_pieces = peer_pieces[peer.id]
+            ids = self.peer_ids
+            (peers, pieces, starts) = (batch.peers, batch.pieces, batch.starts)
+
+            checks = [
+                (lambda k: pieces[k] < 0 or pieces[k] >= num_pieces,
+                 "Request asks for non-existent piece!"),
+                (lambda k: peers[k] < 0 or peers[k] >= n,
+                 "Request mentions non-existent peer!")]
+            if (min(pieces) < 0 or max(pieces) >= num_pieces or
+                min(peers) < 0 or max(peers) >= n):
+                check_all(checks, IllegalRequest, xrange(len(batch)),
+                          batch.request)
+
+            checks = [
+                (lambda k: (starts[k] < 0 or starts[k] >= bpp or
+                            starts[k] > my_pieces[pieces[k]]),
+                 "Request has bad start block!"),
+                (lambda k: pieces[k] not in available[ids[peers[k]]],
+                 "Asking for piece peer does not have!")]
+            check_all(checks, IllegalRequest, xrange(len(batch)),
+                      batch.request)
+
         def available_pieces(peer_id, peer_pieces):
             """
             Return a list of piece ids that this peer has available.
             """
-            return filter(lambda i: peer_pieces[peer_id][i] == conf.blocks_per_piece,
+            pieces = peer_pieces[peer_id]
+            return filter(lambda i: pieces[i] == conf.blocks_per_piece,
                           range(conf.num_pieces))
 
         def peer_done(peer_pieces, peer_id):
@@ -130,6 +252,12 @@ class Sim:
             return True
             
         def all_done(peer_pieces):
+            if isinstance(peer_pieces, SwarmState):
+                # Only peers that finished this round need recording
+                for peer_id in peer_pieces.newly_finished():
+                    history.peer_is_done(round, peer_id)
+                return peer_pieces.all_finished()
+
             result = True
             # Check all peers to update done status
             for peer_id in peer_pieces:
@@ -141,8 +269,8 @@ class Sim:
 
         def create_peers():
             """Each agent class must be already loaded, and have a
-            constructor that takes the config, id,  pieces, and
-            up and down bandwidth, in that order."""
+            constructor that takes the config, id,  pieces,
+            up bandwidth and random.Random, in that order."""
 
             def load(class_name, params):
                 agent_class = conf.agent_classes[class_name]
@@ -159,7 +287,9 @@ class Sim:
                 return a
 
             n = len(conf.agent_class_names)
-            ids = map(lambda n: "%s%d" % (n,index(n)), conf.agent_class_names)
+            # Interned, so the many dict lookups by id can compare pointers
+            ids = map(lambda n: intern("%s%d" % (n,index(n))),
+                      conf.agent_class_names)
 
             is_seed = lambda id: id.startswith("Seed")
 
@@ -169,107 +299,144 @@ class Sim:
                 else:
                     return [0]*conf.num_pieces
                 
-            peer_pieces = dict()  # id -> list (blocks / piece)
-            peer_pieces = dict((id, get_pieces(id)) for id in ids)
             pieces = [get_pieces(id) for id in ids]
+            if conf.engine == "array":
+                peer_pieces = SwarmState(ids, pieces, conf.blocks_per_piece)
+            else:
+                peer_pieces = dict()  # id -> list (blocks / piece)
+                peer_pieces = dict((id, get_pieces(id)) for id in ids)
             r = itertools.repeat
             
             # Re-initialize upload bandwidths at the beginning of each
             # new simulation
             up_bws = [self.up_bw(id, reinit=True) for id in ids] 
-            params = zip(r(conf), ids, pieces, up_bws)
+            rngs = [self.rng("peer", id) for id in ids]
+            params = zip(r(conf), ids, pieces, up_bws, rngs)
 
             peers = map(load, conf.agent_class_names, params)
             #logging.debug("Peers: \n" + "\n".join(str(p) for p in peers))
             return peers, peer_pieces
 
-        def get_peer_requests(p, peer_info, peer_history, peer_pieces, available):
-            def remove_me(info):
-                # TODO: Do we need this linear pass?
-                return filter(lambda peer: peer.id != p.id, peer_info)
-
-            pieces = copy.copy(peer_pieces[p.id])
-            # Made copy of pieces and the peer info this peer needs to make it's
-            # decision, so that it can't change the simulation's copies.
+        def call_agent(p, method, seconds, *args):
+            """
+            Call p's requests() or uploads() (method) with args, allowing
+            it seconds of wall time.  If it runs over, log it, count it
+            against the peer, and return an empty list (or batch) instead.
+            """
+            try:
+                return call_with_limit(seconds, getattr(p, method), *args)
+            except CallTimeout:
+                self.overruns[p.id] += 1
+                logging.warning("Round %d: %s.%s() took more than %gs; "
+                                "using no %s", round, p.id, method, seconds,
+                                method)
+                if not p.batch_protocol:
+                    return []
+                if method == "requests":
+                    return RequestBatch(p.id, self.peer_ids)
+                return UploadBatch(p.id, self.peer_ids)
+
+        def get_peer_requests(p, view, peer_history, peer_pieces, available):
+            """Return p's requests for this round as a RequestBatch."""
+            pieces = peer_pieces[p.id]
+            # Make a copy of pieces, so that the peer can't change the
+            # simulation's copy.  (SwarmState rows are already copies.)  The
+            # peer view is read-only, so it's shared.
+            if not isinstance(peer_pieces, SwarmState):
+                pieces = copy.copy(pieces)
             p.update_pieces(pieces)
-            rs = p.requests(remove_me(peer_info), peer_history)
-            check_requests(p, rs, peer_pieces, available)
-            return rs
-
-        def get_peer_uploads(all_requests, p, peer_info, peer_history):
-            def remove_me(info):
-                # TODO: remove this pass?  Use a set?
-                return filter(lambda peer: peer.id != p.id, peer_info)
-
-            def requests_to(id):
-                f = lambda r: r.peer_id == id
-                ans = []
-                for rs in all_requests.values():
-                    ans.extend(filter(f, rs))
-                return ans
-
-            requests = requests_to(p.id)
-
-            us = p.uploads(requests, remove_me(peer_info), peer_history)
-            check_uploads(p, us)
-            return us
-
-        def upload_rate(uploads, uploader_id, requester_id):
+            if conf.requests_budget > 0:
+                rs = call_agent(p, "requests", conf.requests_budget,
+                                view, peer_history)
+            else:
+                rs = p.requests(view, peer_history)
+            if p.batch_protocol:
+                if should_check(p):
+                    check_request_batch(p, rs, peer_pieces, available)
+                return rs
+            if should_check(p):
+                check_requests(p, rs, peer_pieces, available)
+            try:
+                return RequestBatch.from_requests(p.id, self.peer_ids,
+                                                  self.peer_index, rs)
+            except KeyError, e:
+                raise IllegalRequest("Request mentions non-existent peer! %s"
+                                     % e)
+
+        def build_inboxes(all_requests):
             """
-            return the uploading rate from uploader to requester
-            in blocks per time period, or 0 if not uploading.
+            Bucket this round's requests by the peer they're sent to, in a
+            single pass.  Returns dict: peer_id -> RequestInbox
+
+            all_requests: dict peer_id -> RequestBatch
             """
-            for u in uploads[uploader_id]:
-                if u.to_id == requester_id:
-                    return u.bw
-            return 0
+            inboxes = dict((pid, RequestInbox()) for pid in self.peer_ids)
+            for rs in all_requests.values():
+                for r in rs:
+                    inboxes[r.peer_id].add(r)
+            return inboxes
+
+        def get_peer_uploads(inbox, p, view, peer_history):
+            """Return p's uploads for this round as an UploadBatch."""
+            if conf.uploads_budget > 0:
+                us = call_agent(p, "uploads", conf.uploads_budget,
+                                inbox, view, peer_history)
+            else:
+                us = p.uploads(inbox, view, peer_history)
+            if p.batch_protocol:
+                if should_check(p):
+                    check_upload_batch(p, us)
+                return us
+            if should_check(p):
+                check_uploads(p, us)
+            return UploadBatch.from_uploads(p.id, self.peer_ids,
+                                            self.peer_index, us)
+
+        def mark_available(peer_id, piece_id):
+            if piece_id not in available[peer_id]:
+                available[peer_id].add(piece_id)
+                piece_counts.add_holder(piece_id)
+                changed_peers.add(peer_id)
 
         def update_peer_pieces(peer_pieces, requests, uploads, available):
             """
             Process the uploads: figure out how many blocks of all the requested
-            pieces the requesters ended up with.
+            pieces the requesters ended up with (see transfer.py).
             Make sure requesting the same thing from lots of peers doesn't
             stack.
             update the sets of available pieces as needed.
+
+            requests, uploads: dict peer_id -> RequestBatch / UploadBatch
+
+            With the array engine, peer_pieces is updated in place and
+            returned; otherwise a new dict is returned.
             """
             downloads = dict()  # peer_id -> [downloads]
-            new_pp = copy.deepcopy(peer_pieces)
+            in_place = isinstance(peer_pieces, SwarmState)
+            if in_place:
+                new_pp = peer_pieces
+            else:
+                new_pp = copy.deepcopy(peer_pieces)
+            transfers = self.resolve_transfers(
+                requests, uploads, self.peer_ids, self.peer_index,
+                conf.blocks_per_piece, id_order)
             for requester_id in requests:
                 downloads[requester_id] = list()
             for requester_id in requests:
-                # Keep track of how many blocks of each piece this
-                # requester got.  piece -> (blocks, from_who)
-                new_blocks_per_piece = dict()
-                def update_count(piece_id, blocks, peer_id):
-                    if piece_id in new_blocks_per_piece:
-                        old = new_blocks_per_piece[piece_id][0]
-                        if blocks > old:
-                            new_blocks_per_piece[piece_id] = (blocks, peer_id)
+                for (piece_id, blocks, peer_id) in transfers[requester_id]:
+                    if in_place:
+                        new_pp.add_blocks(requester_id, piece_id, blocks)
                     else:
-                        new_blocks_per_piece[piece_id] = (blocks, peer_id)
-
-                # Group the requests by peer that is being asked
-                get_peer_id = lambda r: r.peer_id
-                rs = sorted(requests[requester_id], key=get_peer_id)
-                for peer_id, rs_for_peer in itertools.groupby(rs, get_peer_id):
-                    bw = upload_rate(uploads, peer_id, requester_id)
-                    if bw == 0:
-                        continue
-                    # This bandwidth gets applied in order to each piece requested
-                    for r in rs_for_peer:
-                        needed_blocks = conf.blocks_per_piece - r.start
-                        alloced_bw = min(bw, needed_blocks)
-                        update_count(r.piece_id, alloced_bw, peer_id)
-                        bw -= alloced_bw
-                        if bw == 0:
-                            break
-                for piece_id in new_blocks_per_piece:
-                    (blocks, peer_id) = new_blocks_per_piece[piece_id]
-                    new_pp[requester_id][piece_id] += blocks
-                    if new_pp[requester_id][piece_id] == conf.blocks_per_piece:
-                        available[requester_id].add(piece_id)
+                        new_pp[requester_id][piece_id] += blocks
+                        if new_pp[requester_id][piece_id] == conf.blocks_per_piece:
+                            mark_available(requester_id, piece_id)
                     d = Download(peer_id, requester_id, piece_id, blocks)
                     downloads[requester_id].append(d)
+
+            if in_place:
+                # Find all the newly finished pieces in one go
+                for (requester_id, piece_id) in new_pp.completed_pieces():
+                    mark_available(requester_id, piece_id)
                 
             return (new_pp, downloads)
 
@@ -277,54 +444,130 @@ class Sim:
             return len(available[peer_id])
         
         def log_peer_info(peer_pieces, available):
-            for p_id in self.peer_ids:
-                pieces = peer_pieces[p_id]
-                logging.debug("pieces for %s: %s" % (str(p_id), str(pieces)))
-            log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
-                            for p_id in self.peer_ids)
-            logging.info("Pieces completed: " + log)
-
-
-        logging.debug("Starting simulation with config: %s" % str(conf))
+            root_logger = logging.getLogger()
+            if root_logger.isEnabledFor(logging.DEBUG):
+                for p_id in self.peer_ids:
+                    pieces = peer_pieces[p_id]
+                    logging.debug("pieces for %s: %s", p_id, pieces)
+            if root_logger.isEnabledFor(logging.INFO):
+                log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
+                                for p_id in self.peer_ids)
+                logging.info("Pieces completed: %s", log)
+
+        def dump_history():
+            """Stream the full history to conf.history_out, or log it."""
+            if conf.history_out is None:
+                logging.info("Game history:\n%s", LazyStr(history.pretty))
+                return
+            path = conf.history_out
+            if conf.iters > 1:
+                path = "%s.%d" % (path, self.iteration)
+            f = open(path, "w")
+            try:
+                history.write_pretty(f)
+            finally:
+                f.close()
+            logging.info("Game history written to %s", path)
+
+
+        timer = self.timer
+        if timer is not None:
+            # The helpers are looked up when they're called, so re-binding
+            # them here times every call.  Nothing changes without a timer.
+            get_peer_requests = timer.wrap("requests", get_peer_requests)
+            check_requests = timer.wrap("validation", check_requests)
+            check_request_batch = timer.wrap("validation", check_request_batch)
+            build_inboxes = timer.wrap("uploads", build_inboxes)
+            get_peer_uploads = timer.wrap("uploads", get_peer_uploads)
+            check_uploads = timer.wrap("validation", check_uploads)
+            check_upload_batch = timer.wrap("validation", check_upload_batch)
+            update_peer_pieces = timer.wrap("transfer", update_peer_pieces)
+
+        logging.debug("Starting simulation with config: %s", conf)
 
         peers, peer_pieces = create_peers()
         self.peer_ids = [p.id for p in peers]
-        self.peers_by_id = dict((p.id, p) for p in peers)
+        self.peer_index = dict((pid, i) for (i, pid) in enumerate(self.peer_ids))
+        id_order = sort_positions(self.peer_ids)
+        self.overruns = dict((pid, 0) for pid in self.peer_ids)
         
         upload_rates = dict((id, self.up_bw(id)) for id in self.peer_ids)
-        history = History(self.peer_ids, upload_rates)
+        if conf.history_window > 0:
+            history = SpillingHistory(self.peer_ids, upload_rates,
+                                      conf.history_window, conf.history_dir)
+        else:
+            history = History(self.peer_ids, upload_rates)
+        update_history = history.update
+        if timer is not None:
+            update_history = timer.wrap("history", update_history)
 
         # dict : pid -> set(finished / available pieces)
         available = dict((pid, set(available_pieces(pid, peer_pieces)))
                          for pid in self.peer_ids)
 
+        # How many peers have each piece.  Agents get a read-only view.
+        piece_counts = PieceCounts(conf.num_pieces, available)
+        rarity = piece_counts.view()
+        for p in peers:
+            p.update_rarity(rarity)
+            p.update_index(self.peer_ids, self.peer_index)
+            if timer is not None and timer.by_agent:
+                name = p.__class__.__name__
+                p.requests = timer.wrap(name + ".requests", p.requests)
+                p.uploads = timer.wrap(name + ".uploads", p.uploads)
+
+        tracer = None
+        if conf.trace_dir is not None:
+            path = os.path.join(conf.trace_dir, "iter%d.trace" % self.iteration)
+            tracer = TraceWriter(path, self.peer_ids, upload_rates, conf,
+                                 self.seed)
+
+        # Read-only PeerInfo snapshots, in peer order.  Only the peers in
+        # changed_peers got new pieces last round and need a new snapshot.
+        snapshots = [PeerInfo(p.id, available[p.id]) for p in peers]
+        changed_peers = set()
+
         # Begin the event loop
         while True:
-            logging.info("======= Round %d ========" % round)
+            logging.info("======= Round %d ========", round)
+
+            for pid in changed_peers:
+                snapshots[self.peer_index[pid]] = PeerInfo(pid, available[pid])
+            changed_peers.clear()
+            peer_info = tuple(snapshots)
 
-            peer_info = [PeerInfo(p.id, available[p.id])
-                         for p in peers]
-            requests = dict()  # peer_id -> list of Requests
-            uploads = dict()   # peer_id -> list of Uploads
+            requests = dict()  # peer_id -> RequestBatch
+            uploads = dict()   # peer_id -> UploadBatch
             h = dict()
-            for p in peers:
+            views = dict()     # peer_id -> PeerView of everyone else
+            for (i, p) in enumerate(peers):
                 h[p.id] = history.peer_history(p.id)
-                requests[p.id] = get_peer_requests(p, peer_info, h[p.id], peer_pieces,
-                                                   available)
+                views[p.id] = PeerView(peer_info, i, round)
+                requests[p.id] = get_peer_requests(p, views[p.id], h[p.id],
+                                                   peer_pieces, available)
 
+            inboxes = build_inboxes(requests)
             for p in peers:
-                uploads[p.id] = get_peer_uploads(requests, p, peer_info, h[p.id])
+                uploads[p.id] = get_peer_uploads(inboxes[p.id], p, views[p.id],
+                                                 h[p.id])
                 
 
             (peer_pieces, downloads) = update_peer_pieces(
                 peer_pieces, requests, uploads, available)
-            history.update(downloads, uploads)
+            update_history(downloads, uploads)
 
-            logging.debug(history.pretty_for_round(round))
+            logging.debug("%s", LazyStr(history.pretty_for_round, round))
 
             log_peer_info(peer_pieces, available)
+
+            done = all_done(peer_pieces)
+            if tracer is not None:
+                finished = [pid for (pid, r) in history.round_done.items()
+                            if r == round]
+                tracer.write_round(round, requests, uploads, downloads,
+                                   finished)
            
-            if all_done(peer_pieces):
+            if done:
                 logging.info("All done!")                    
                 break
             round += 1
@@ -332,82 +575,347 @@ class Sim:
                 logging.info("Out of time.  Stopping.")
                 break
 
-        logging.info("Game history:\n%s" % history.pretty())
+        if tracer is not None:
+            tracer.close()
 
-        logging.info("======== STATS ========")
-        logging.info("Uploaded blocks:\n%s" %
-                     Stats.uploaded_blocks_str(self.peer_ids, history))
-        logging.info("Completion rounds:\n%s" %
-                     Stats.completion_rounds_str(self.peer_ids, history))
-        logging.info("All done round: %s" %
-                     Stats.all_done_round(self.peer_ids, history))
+        dump_history()
+        log_run_stats(self.peer_ids, history)
+        if any(self.overruns.values()):
+            logging.warning("Calls over the time budget: %s",
+                            ", ".join("%s:%d" % (pid, self.overruns[pid])
+                                      for pid in self.peer_ids
+                                      if self.overruns[pid] > 0))
 
         return history
 
     def run_sim(self):
-        histories = map(lambda i: self.run_sim_once(), 
-                        range(self.config.iters))
-        logging.warning("======== SUMMARY STATS ========")
-        
-        uploaded_blocks = map(
-            lambda h: Stats.uploaded_blocks(self.peer_ids, h),
-            histories)
-        completion_rounds = map(
-            lambda h: Stats.completion_rounds(self.peer_ids, h),
-            histories)
-
-        def extract_by_peer_id(lst, peer_id):
-            """Given a list of dicts, pull out the entry
-            for peer_id from each dict.  Return a list"""
-            return map(lambda d: d[peer_id], lst)
-
-        uploaded_by_id = dict(
-            (p_id, extract_by_peer_id(uploaded_blocks, p_id))
-            for p_id in self.peer_ids)
-
-        completion_by_id = dict(
-            (p_id, extract_by_peer_id(completion_rounds, p_id))
-            for p_id in self.peer_ids)
-
-        logging.warning("Uploaded blocks: avg (stddev)")
-        for p_id in sorted(self.peer_ids,
-                           key=lambda id: mean(uploaded_by_id[id])):
-            us = uploaded_by_id[p_id]
-            logging.warning("%s: %.1f  (%.1f)" % (p_id, mean(us), stddev(us)))
-
-        logging.warning("Completion rounds: avg (stddev)")
-
-        def optionize(f):
-            def g(lst):
-                if None in lst:
-                    return None
-                else:
-                    return f(lst)
-            return g
+        conf = self.config
+        # Each iteration gets its own seed, derived from the root seed, so
+        # the results don't depend on which worker runs which iteration.
+        jobs = [(conf, i, derive_seed(conf.seed, "iter", i))
+                for i in range(conf.iters)]
+
+        n_workers = min(conf.jobs, conf.iters)
+        pool = None
+        if n_workers > 1:
+            flush_logging()
+            pool = multiprocessing.Pool(n_workers)
+            results = itertools.imap(
+                print_output,
+                pool.imap(run_iteration_captured, jobs, chunksize=1))
+        else:
+            results = itertools.imap(run_iteration, jobs)
 
-        opt_mean = optionize(mean)
-        opt_stddev = optionize(stddev)
-        
-        for p_id in sorted(self.peer_ids,
-                           key=lambda id: opt_mean(completion_by_id[id])):
-            cs = completion_by_id[p_id]
-            logging.warning("%s: %s  (%s)" % (p_id, opt_mean(cs), opt_stddev(cs)))
+        # Fold each iteration into running stats as it arrives, in
+        # iteration order, instead of keeping them all.
+        summary = None
+        profile = None
+        try:
+            for (peer_ids, uploaded_blocks, completion_rounds, overruns,
+                 iter_profile) in results:
+                if summary is None:
+                    self.peer_ids = peer_ids
+                    summary = IterationSummary(peer_ids)
+                summary.add(uploaded_blocks, completion_rounds, overruns)
+                if iter_profile is not None:
+                    if profile is None:
+                        profile = iter_profile
+                    else:
+                        profile.merge(iter_profile)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        log_summary(summary)
+        if profile is not None:
+            log_profile(profile)
+
+
+def log_run_stats(peer_ids, history):
+    """Log the stats for a single run."""
+    logging.info("======== STATS ========")
+    logging.info("Uploaded blocks:\n%s",
+                 LazyStr(Stats.uploaded_blocks_str, peer_ids, history))
+    logging.info("Completion rounds:\n%s",
+                 LazyStr(Stats.completion_rounds_str, peer_ids, history))
+    logging.info("All done round: %s",
+                 LazyStr(Stats.all_done_round, peer_ids, history))
+
+
+def log_summary(summary):
+    """Log the stats across iterations, from an IterationSummary."""
+    logging.warning("======== SUMMARY STATS ========")
+
+    peer_ids = summary.peer_ids
+    uploaded = summary.uploaded
+    logging.warning("Uploaded blocks: avg (stddev)")
+    for p_id in sorted(peer_ids,
+                       key=lambda id: uploaded[id].mean()):
+        us = uploaded[p_id]
+        logging.warning("%s: %.1f  (%.1f)" % (p_id, us.mean(), us.stddev()))
+
+    logging.warning("Completion rounds: avg (stddev)")
+    for p_id in sorted(peer_ids, key=summary.completion_mean):
+        logging.warning("%s: %s  (%s)" % (p_id, summary.completion_mean(p_id),
+                                          summary.completion_stddev(p_id)))
+
+    overrun = [p_id for p_id in peer_ids if summary.overruns[p_id] > 0]
+    if overrun:
+        logging.warning("Calls over the time budget: total (per iteration)")
+        for p_id in sorted(overrun, key=summary.overruns.get, reverse=True):
+            n = summary.overruns[p_id]
+            logging.warning("%s: %d  (%.1f)" % (p_id, n,
+                                                float(n) / summary.iters))
+
+
+def log_profile(profile):
+    """Log a CallProfile's report, slowest phase or agent method first."""
+    logging.warning("======== PROFILE ========")
+    for line in profile.report():
+        logging.warning(line)
+
+
+# The settings besides the agents and the seed that decide a run's results.
+# engine and the validation settings don't change a run that completes,
+# but they're in the key anyway: a strict run has to raise for an illegal
+# request or upload rather than return what an unchecked run cached.  The
+# rest of the config either stops a run being cached (see cacheable()) or
+# only changes how it's run and logged.
+RESULT_SETTINGS = ["num_pieces", "blocks_per_piece", "max_round",
+                   "min_up_bw", "max_up_bw", "engine", "validate",
+                   "validate_every"]
+
+
+def cacheable(config):
+    """
+    Whether runs with config can use the result cache.  Not if it's
+    bypassed, if the run has to happen for its side effects (traces,
+    history dumps, profiles), or if time budgets make it depend on timing.
+    """
+    return (config.cache_dir is not None and not config.no_cache and
+            config.trace_dir is None and config.history_out is None and
+            not config.profile and config.requests_budget <= 0 and
+            config.uploads_budget <= 0)
+
+
+def iteration_key(config, seed, digest=None):
+    """
+    Result cache key for a run: the agents' and engine's source, the
+    agents, the settings that matter, and the seed.  Everything that
+    caches runs (sim.py, tournament.py, sweep.py) keys them with this.
+
+    digest: source_digest(config.agent_classes), if the caller already
+        has it
+    """
+    if digest is None:
+        digest = source_digest(config.agent_classes)
+    settings = dict((k, getattr(config, k)) for k in RESULT_SETTINGS)
+    return result_key(digest, config.agent_class_names, settings, seed)
+
+
+def cached_iteration(cache, key, config, iteration):
+    """
+    The run_iteration result stored under key, or None.  Logs the run's
+    stats if the history was stored too.
+    """
+    cached = cache.get(key)
+    if cached is None:
+        return None
+    if config.cache_history and "history" not in cached:
+        return None   # rerun it to get the history
+    logging.info("Iteration %d: using cached result", iteration)
+    peer_ids = [str(pid) for pid in cached["peer_ids"]]
+    if "history" in cached:
+        history = History.from_compact(cached["history"])
+        logging.info("Game history:\n%s", LazyStr(history.pretty))
+        log_run_stats(peer_ids, history)
+    return (peer_ids,
+            dict((str(pid), v) for (pid, v) in cached["uploaded"].items()),
+            dict((str(pid), v) for (pid, v) in cached["completion"].items()),
+            dict((pid, 0) for pid in peer_ids),
+            None)
+
+
+# (cache dir, max bytes) -> ResultCache, one per process, so the cache's
+# size is only counted once rather than on every iteration
+_result_caches = dict()
+
+
+def result_cache(dir, max_bytes):
+    key = (dir, max_bytes)
+    if key not in _result_caches:
+        _result_caches[key] = ResultCache(dir, max_bytes)
+    return _result_caches[key]
+
+
+def run_iteration(job):
+    """
+    job: (config, iteration, seed)
 
+    Run one simulation with its random streams seeded from seed.  Lives at
+    module level so it can be shipped to worker processes.
 
+    Returns (peer_ids, uploaded_blocks, completion_rounds, overruns,
+    profile).  uploaded_blocks and completion_rounds are the Stats dicts for
+    this run, overruns is dict peer_id -> calls over the time budget, and
+    profile is a CallProfile if config.profile is set, or None.
+    """
+    (config, iteration, seed) = job
+    cache = None
+    if cacheable(config):
+        cache = result_cache(config.cache_dir, config.cache_max_bytes)
+        key = iteration_key(config, seed)
+        result = cached_iteration(cache, key, config, iteration)
+        if result is not None:
+            flush_logging()
+            return result
 
-def configure_logging(loglevel):
+    # For agents that still use the random module
+    random.seed(seed)
+    sim = Sim(config, seed)
+    sim.iteration = iteration
+    if config.profile:
+        sim.timer = CallProfile()
+        sim.timer.start()
+        try:
+            history = sim.run_sim_once()
+        finally:
+            sim.timer.stop()
+    else:
+        history = sim.run_sim_once()
+    result = (sim.peer_ids,
+              Stats.uploaded_blocks(sim.peer_ids, history),
+              Stats.completion_rounds(sim.peer_ids, history),
+              sim.overruns,
+              sim.timer)
+    if cache is not None:
+        value = {"peer_ids": result[0],
+                 "uploaded": result[1],
+                 "completion": result[2]}
+        if config.cache_history:
+            value["history"] = history.compact()
+        cache.put(key, value)
+    history.close()
+    # Worker processes exit without shutting logging down
+    flush_logging()
+    return result
+
+
+def run_iteration_captured(job):
+    """
+    run_iteration() for a worker process.  Everything written to stdout
+    meanwhile (agents' prints, log records) is captured instead, and
+    returned as (output, result) for the parent to print in iteration
+    order, so the output is the same as a serial run's.
+    """
+    sys.stdout.flush()
+    out = tempfile.TemporaryFile()
+    saved = os.dup(1)
+    os.dup2(out.fileno(), 1)
+    try:
+        result = run_iteration(job)
+        sys.stdout.flush()
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+    out.seek(0)
+    output = out.read()
+    out.close()
+    return (output, result)
+
+
+def print_output(captured):
+    """Print the output run_iteration_captured() captured, and return the
+    result."""
+    (output, result) = captured
+    flush_logging()
+    sys.stdout.write(output)
+    sys.stdout.flush()
+    return result
+
+
+def configure_logging(loglevel, async=False, log_file=None, compress=False,
+                      max_bytes=0, backups=5):
+    """
+    Log to stdout, or to log_file (optionally gzipped and rotated every
+    max_bytes).  If async is set, records are written by a background
+    thread instead of blocking the simulation.
+    """
     numeric_level = getattr(logging, loglevel.upper(), None)
     if not isinstance(numeric_level, int):
         raise ValueError('Invalid log level: %s' % loglevel)
 
+    if log_file is None:
+        out = sys.__stdout__
+    else:
+        out = RotatingFileWriter(log_file, max_bytes, backups, compress)
+
     root_logger = logging.getLogger('')
-    strm_out = logging.StreamHandler(sys.__stdout__)
+    if async:
+        strm_out = AsyncLogHandler(out, close_stream=log_file is not None)
+    elif log_file is not None:
+        strm_out = ClosingStreamHandler(out)
+    else:
+        strm_out = logging.StreamHandler(out)
 #    strm_out.setFormatter(logging.Formatter('%(levelno)s: %(message)s'))
     strm_out.setFormatter(logging.Formatter('%(message)s'))
     root_logger.setLevel(numeric_level)
     root_logger.addHandler(strm_out)
+
+
+def flush_logging():
+    """Wait for all log handlers to write out what they have."""
+    for handler in logging.getLogger('').handlers:
+        handler.flush()
     
 
+# Settings a config needs besides the agents, with the same defaults as
+# main's options
+CONFIG_DEFAULTS = [
+    ("num_pieces", 3),
+    ("blocks_per_piece", 4),
+    ("max_round", 5),
+    ("min_up_bw", 4),
+    ("max_up_bw", 10),
+    ("iters", 1),
+    ("engine", "dict"),
+    ("validate", "strict"),
+    ("validate_every", 10),
+    ("history_window", 0),
+    ("history_dir", None),
+    ("history_out", None),
+    ("trace_dir", None),
+    ("requests_budget", 0),
+    ("uploads_budget", 0),
+    ("jobs", 1),
+    ("seed", None),
+    ("profile", False),
+    ("cache_dir", None),
+    ("cache_max_bytes", 256 * 2**20),   # --cache-max-mb 256
+    ("no_cache", False),
+    ("cache_history", False),
+]
+
+
+def make_config(agent_class_names, **settings):
+    """
+    Build a config for running agent_class_names (a list like
+    parse_agents returns) from code rather than the command line.  Any
+    setting not given gets its default.
+    """
+    unknown = set(settings) - set(k for (k, v) in CONFIG_DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown settings: %s" % ", ".join(sorted(unknown)))
+
+    config = Params()
+    config.add("agent_class_names", agent_class_names)
+    config.add("agent_classes", load_modules(set(agent_class_names)))
+    for (k, default) in CONFIG_DEFAULTS:
+        config.add(k, settings.get(k, default))
+    return config
+
+
 def parse_agents(args):
     """
     Each element is a class name like "Peer", with an optional
@@ -442,6 +950,27 @@ def main(args):
                       dest="loglevel", default="info",
                       help="Set the logging level: 'debug' or 'info'")
 
+    parser.add_option("--log-async",
+                      dest="log_async", default=False, action="store_true",
+                      help="Write log output from a background thread")
+
+    parser.add_option("--log-file",
+                      dest="log_file", default=None,
+                      help="Log to this file instead of stdout")
+
+    parser.add_option("--log-compress",
+                      dest="log_compress", default=False, action="store_true",
+                      help="gzip the log file")
+
+    parser.add_option("--log-max-bytes",
+                      dest="log_max_bytes", default=0, type="int",
+                      help="Start a new log file after this many bytes "
+                      "(0: never)")
+
+    parser.add_option("--log-backups",
+                      dest="log_backups", default=5, type="int",
+                      help="Number of old log files to keep when rotating")
+
     parser.add_option("--num-pieces",
                       dest="num_pieces", default=3, type="int",
                       help="Set number of pieces in the file")
@@ -466,8 +995,89 @@ def main(args):
                       dest="iters", default=1, type="int",
                       help="Number of times to run simulation to get stats")
 
-
-    (options, args) = parser.parse_args()
+    parser.add_option("--engine",
+                      dest="engine", default="dict", type="choice",
+                      choices=["dict", "array"],
+                      help="Swarm state storage: 'dict' of lists or flat 'array'")
+
+    parser.add_option("--validate",
+                      dest="validate", default="strict", type="choice",
+                      choices=["strict", "sampled", "off"],
+                      help="Check agents' requests and uploads: 'strict' "
+                      "(every round), 'sampled', or 'off' for trusted agents")
+
+    parser.add_option("--validate-every",
+                      dest="validate_every", default=10, type="int",
+                      help="In sampled mode, check each peer once every N rounds")
+
+    parser.add_option("--history-window",
+                      dest="history_window", default=0, type="int",
+                      help="Keep only this many recent rounds of history in "
+                      "memory and spill older ones to disk (0: keep all)")
+
+    parser.add_option("--history-dir",
+                      dest="history_dir", default=None,
+                      help="Directory for spilled history files")
+
+    parser.add_option("--history-out",
+                      dest="history_out", default=None,
+                      help="Write each run's full history to this file "
+                      "(suffixed with .N for multiple iterations) instead "
+                      "of logging it")
+
+    parser.add_option("--trace",
+                      dest="trace_dir", default=None,
+                      help="Write a binary event trace of each run to "
+                      "DIR/iter<N>.trace (see replay.py)")
+
+    parser.add_option("--requests-budget",
+                      dest="requests_budget", default=0, type="float",
+                      help="Seconds each requests() call may take before "
+                      "the peer gets no requests that round (0: no limit)")
+
+    parser.add_option("--uploads-budget",
+                      dest="uploads_budget", default=0, type="float",
+                      help="Seconds each uploads() call may take before "
+                      "the peer gets no uploads that round (0: no limit)")
+
+    parser.add_option("--jobs",
+                      dest="jobs", default=1, type="int",
+                      help="Number of worker processes to spread iterations over")
+
+    parser.add_option("--seed",
+                      dest="seed", default=None, type="int",
+                      help="Root random seed.  Picked at random if not given.")
+
+    parser.add_option("--cache-dir",
+                      dest="cache_dir", default=None,
+                      help="Reuse results of identical runs (same agent and "
+                      "engine code, settings and seed) stored in this "
+                      "directory")
+
+    parser.add_option("--cache-max-mb",
+                      dest="cache_max_mb", default=256, type="float",
+                      help="Delete the least recently used cached results "
+                      "beyond this size (0: no limit)")
+
+    parser.add_option("--cache-history",
+                      dest="cache_history", default=False, action="store_true",
+                      help="Store each run's history with its cached result")
+
+    parser.add_option("--no-cache",
+                      dest="no_cache", default=False, action="store_true",
+                      help="Don't read or write the result cache")
+
+    parser.add_option("--profile",
+                      dest="profile", default=False, action="store_true",
+                      help="Report time and allocations for each engine "
+                      "phase and each agent class's requests() and uploads()")
+
+    parser.add_option("--cprofile",
+                      dest="cprofile_out", default=None,
+                      help="Run under cProfile and write the stats to this file")
+
+
+    (options, args) = parser.parse_args(args[1:])
 
     # leftover args are class names, with optional counts:
     # "Peer Seed[,4]"
@@ -481,7 +1091,25 @@ def main(args):
         except ValueError, e:
             usage(e)
     
-    configure_logging(options.loglevel)
+    if options.validate_every < 1:
+        usage("--validate-every must be at least 1")
+
+    if options.jobs < 1:
+        usage("--jobs must be at least 1")
+
+    if options.seed is None:
+        options.seed = random.SystemRandom().randint(0, 2**31 - 1)
+
+    if options.log_compress and options.log_file is None:
+        usage("--log-compress needs --log-file")
+
+    if options.trace_dir is not None and not os.path.isdir(options.trace_dir):
+        os.makedirs(options.trace_dir)
+
+    configure_logging(options.loglevel, options.log_async, options.log_file,
+                      options.log_compress, options.log_max_bytes,
+                      options.log_backups)
+    logging.info("Root seed: %d", options.seed)
     config = Params()
 
     config.add("agent_class_names", agents_to_run)
@@ -494,13 +1122,30 @@ def main(args):
     config.add("min_up_bw", options.min_up_bw)
     config.add("max_up_bw", options.max_up_bw)
     config.add("iters", options.iters)
+    config.add("engine", options.engine)
+    config.add("validate", options.validate)
+    config.add("validate_every", options.validate_every)
+    config.add("history_window", options.history_window)
+    config.add("history_dir", options.history_dir)
+    config.add("history_out", options.history_out)
+    config.add("trace_dir", options.trace_dir)
+    config.add("requests_budget", options.requests_budget)
+    config.add("uploads_budget", options.uploads_budget)
+    config.add("jobs", options.jobs)
+    config.add("seed", options.seed)
+    config.add("profile", options.profile)
+    config.add("cache_dir", options.cache_dir)
+    config.add("cache_max_bytes", int(options.cache_max_mb * 2**20))
+    config.add("no_cache", options.no_cache)
+    config.add("cache_history", options.cache_history)
     
-    sim = Sim(config)
-    sim.run_sim()
+    sim = Sim(config, options.seed)
+    if options.cprofile_out is not None:
+        import cProfile
+        cProfile.runctx('sim.run_sim()', globals(), locals(),
+                        options.cprofile_out)
+    else:
+        sim.run_sim()
 
 if __name__ == "__main__":
-
-    # The next two lines are for profiling...
-    import cProfile
-    cProfile.run('main(sys.argv)', 'out.prof')
-#    main(sys.argv)
+    main(sys.argv)
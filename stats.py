@@ -1,5 +1,66 @@
 #!/usr/bin/python
 
+from util import RunningStats
+
+
+class StatsAccumulator:
+    """
+    Running totals for one run, fed a round at a time by History.update, so
+    they're available mid-run and the end-of-run stats need no rescan.
+
+    uploaded: dict peer_id -> blocks uploaded so far
+    """
+    def __init__(self, peer_ids):
+        self.uploaded = dict((peer_id, 0) for peer_id in peer_ids)
+
+    def add_downloads(self, downloads):
+        """downloads: list of Downloads from the latest round"""
+        for d in downloads:
+            self.uploaded[d.from_id] += d.blocks
+
+
+class IterationSummary:
+    """
+    Reduces each iteration's uploaded_blocks and completion_rounds dicts into
+    per-peer running stats as they arrive, so a summary over many
+    iterations keeps O(peers) state.
+
+    overruns: dict peer_id -> total calls over the time budget
+    """
+    def __init__(self, peer_ids):
+        self.peer_ids = peer_ids[:]
+        self.iters = 0
+        self.uploaded = dict((pid, RunningStats()) for pid in peer_ids)
+        self.completion = dict((pid, RunningStats()) for pid in peer_ids)
+        # peers that didn't finish in at least one iteration
+        self.unfinished = set()
+        self.overruns = dict((pid, 0) for pid in peer_ids)
+
+    def add(self, uploaded_blocks, completion_rounds, overruns=None):
+        for pid in self.peer_ids:
+            if overruns is not None:
+                self.overruns[pid] += overruns[pid]
+            self.uploaded[pid].add(uploaded_blocks[pid])
+            c = completion_rounds[pid]
+            if c is None:
+                self.unfinished.add(pid)
+            else:
+                self.completion[pid].add(c)
+        self.iters += 1
+
+    def completion_mean(self, peer_id):
+        """None if the peer didn't always finish"""
+        if peer_id in self.unfinished:
+            return None
+        return self.completion[peer_id].mean()
+
+    def completion_stddev(self, peer_id):
+        """None if the peer didn't always finish"""
+        if peer_id in self.unfinished:
+            return None
+        return self.completion[peer_id].stddev()
+
+
 class Stats:
     @staticmethod
     def uploaded_blocks(peer_ids, history):
@@ -10,13 +71,9 @@ class Stats:
         Returns:
         dict: peer_id -> total upload blocks used
         """
-        uploaded = dict((peer_id, 0) for peer_id in peer_ids)
-        for peer_id in peer_ids:
-            for ds in history.downloads[peer_id]:
-                for download in ds:
-                    uploaded[download.from_id] += download.blocks
-                
-        return uploaded
+        # History keeps running totals as rounds are added
+        totals = history.totals.uploaded
+        return dict((peer_id, totals[peer_id]) for peer_id in peer_ids)
 
     @staticmethod
     def uploaded_blocks_str(peer_ids, history):
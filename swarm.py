@@ -0,0 +1,209 @@
+#!/usr/bin/python
+
+"""
+Array-backed swarm state.
+
+The block counts for every (peer, piece) pair live in one flat array, one row
+per peer, so a round's transfers can be applied in place instead of
+deep-copying a dict of lists every round.
+"""
+
+import heapq
+from array import array
+
+
+class SwarmState:
+    """
+    blocks: flat array of block counts, row-major by peer index.  Counts are
+            ints until an agent uploads fractional bandwidth, and then
+            doubles from then on.
+    float_cells: None while blocks holds ints.  Afterwards, the set of
+            cells (indexes in blocks) that got a float added, which read
+            back as floats; the rest read back as ints, as they would with
+            the dict engine.
+
+    pieces_left: array, peer index -> number of pieces not yet complete
+    unfinished: set of ids of peers that still need something
+
+    Reads look like the old dict of lists: swarm[peer_id] is a list of
+    block counts (a fresh copy), and iterating gives the peer ids.
+    """
+    def __init__(self, peer_ids, init_pieces, blocks_per_piece):
+        """
+        peer_ids: list of peer ids, in peer index order
+        init_pieces: list of block-count lists, parallel to peer_ids
+        """
+        self.peer_ids = peer_ids[:]
+        self.index = dict((pid, i) for (i, pid) in enumerate(self.peer_ids))
+        self.num_pieces = len(init_pieces[0]) if init_pieces else 0
+        self.blocks_per_piece = blocks_per_piece
+
+        flat = []
+        self.pieces_left = array('i')
+        for pieces in init_pieces:
+            flat.extend(pieces)
+            self.pieces_left.append(
+                len([b for b in pieces if b < blocks_per_piece]))
+        float_cells = set(cell for (cell, b) in enumerate(flat)
+                          if not isinstance(b, (int, long)))
+        if float_cells:
+            self.blocks = array('d', flat)
+            self.float_cells = float_cells
+        else:
+            self.blocks = array('i', flat)
+            self.float_cells = None
+
+        self.unfinished = set(pid for (i, pid) in enumerate(self.peer_ids)
+                              if self.pieces_left[i] > 0)
+        # cells written since the last call to completed_pieces()
+        self.touched = []
+        # peers that finished since the last call to newly_finished().
+        # Peers that start out with everything count as finishing at once.
+        self.finished = [pid for pid in self.peer_ids
+                         if pid not in self.unfinished]
+
+    def __getitem__(self, peer_id):
+        n = self.num_pieces
+        start = self.index[peer_id] * n
+        row = self.blocks[start:start + n].tolist()
+        if self.float_cells:
+            float_cells = self.float_cells
+            for j in xrange(n):
+                if start + j not in float_cells:
+                    row[j] = int(row[j])
+        return row
+
+    def __iter__(self):
+        return iter(self.peer_ids)
+
+    def __len__(self):
+        return len(self.peer_ids)
+
+    def __contains__(self, peer_id):
+        return peer_id in self.index
+
+    def get(self, peer_id, piece_id):
+        """Return the number of blocks peer_id has of piece_id."""
+        cell = self.index[peer_id] * self.num_pieces + piece_id
+        b = self.blocks[cell]
+        if self.float_cells is None or cell in self.float_cells:
+            return b
+        return int(b)
+
+    def add_blocks(self, peer_id, piece_id, blocks):
+        """Give peer_id blocks more blocks of piece_id, in place."""
+        i = self.index[peer_id]
+        cell = i * self.num_pieces + piece_id
+        if not isinstance(blocks, (int, long)):
+            if self.float_cells is None:
+                self.blocks = array('d', self.blocks)
+                self.float_cells = set()
+            self.float_cells.add(cell)
+        old = self.blocks[cell]
+        self.blocks[cell] = old + blocks
+        self.touched.append(cell)
+
+        bpp = self.blocks_per_piece
+        if old < bpp and old + blocks >= bpp:
+            self.pieces_left[i] -= 1
+            if self.pieces_left[i] == 0:
+                self.unfinished.discard(peer_id)
+                self.finished.append(peer_id)
+
+    def completed_pieces(self):
+        """
+        Return a list of (peer_id, piece_id) pairs for pieces that were
+        written since the last call and now have exactly blocks_per_piece
+        blocks.  Resets the list of written cells.
+        """
+        blocks = self.blocks
+        bpp = self.blocks_per_piece
+        n = self.num_pieces
+        done = [(self.peer_ids[cell // n], cell % n)
+                for cell in self.touched if blocks[cell] == bpp]
+        self.touched = []
+        return done
+
+    def newly_finished(self):
+        """
+        Return the ids of peers that got their last piece since the last
+        call, and reset the list.
+        """
+        done = self.finished
+        self.finished = []
+        return done
+
+    def all_finished(self):
+        return len(self.unfinished) == 0
+
+    def __repr__(self):
+        return "SwarmState(peers=%d, pieces=%d)" % (
+            len(self.peer_ids), self.num_pieces)
+
+
+class PieceCounts:
+    """
+    Swarm-wide availability: for each piece, how many peers have all of it.
+    The sim keeps it up to date as pieces complete.  Agents get a read-only
+    RarityView of it instead.
+
+    changes: list of piece ids, one entry each time a piece's count went up,
+             oldest first.  Its length is the current version.
+    """
+    def __init__(self, num_pieces, available):
+        """
+        available: dict peer_id -> set of available pieces
+        """
+        self.counts = array('i', [0] * num_pieces)
+        for pieces in available.values():
+            for piece_id in pieces:
+                self.counts[piece_id] += 1
+        self.changes = []
+
+    def add_holder(self, piece_id):
+        """Record that one more peer has piece_id."""
+        self.counts[piece_id] += 1
+        self.changes.append(piece_id)
+
+    def view(self):
+        return RarityView(self)
+
+
+class RarityView:
+    """
+    Read-only view of a PieceCounts.  It stays current as the sim runs, so
+    agents can hold on to it.
+    """
+    def __init__(self, piece_counts):
+        self._pc = piece_counts
+
+    def count(self, piece_id):
+        """Number of peers that have all of piece_id."""
+        return self._pc.counts[piece_id]
+
+    __getitem__ = count
+
+    def __len__(self):
+        return len(self._pc.counts)
+
+    def rarest(self, pieces, n=None):
+        """
+        Return the given piece ids ordered from fewest to most holders.
+        Ties keep the order they came in.  If n is given, only the n
+        rarest are returned.
+        """
+        key = self._pc.counts.__getitem__
+        if n is None:
+            return sorted(pieces, key=key)
+        return heapq.nsmallest(n, pieces, key=key)
+
+    def version(self):
+        """Changes so far.  Pass to changed_since() later on."""
+        return len(self._pc.changes)
+
+    def changed_since(self, version):
+        """Piece ids whose count went up since version (with repeats)."""
+        return self._pc.changes[version:]
+
+    def __repr__(self):
+        return "RarityView(%s)" % self._pc.counts.tolist()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+Parameter sweeps that survive being interrupted.  The grid of agent mixes,
+population scales, bandwidths, piece counts and blocks per piece is
+expanded into jobs, one per run, which are spread over a pool of worker
+processes.  Each finished job is appended to a JSON-lines results file and
+synced to disk, and a restarted sweep skips the jobs already in the file.
+
+A job's seed depends only on its iteration number (as in sim.py --seed),
+so the results don't depend on which worker ran what, in what order, or on
+how many restarts it took.
+"""
+
+import os
+import sys
+import json
+import logging
+import itertools
+import multiprocessing
+from optparse import OptionParser
+
+from sim import make_config, parse_agents, configure_logging, iteration_key
+from util import derive_seed, RunningStats
+from cache import source_digest
+from tournament import init_worker, run_job
+
+
+def scale_mix(names, scale):
+    """Each agent in the mix, scale times over."""
+    ans = []
+    for name in names:
+        ans.extend([name] * scale)
+    return ans
+
+
+def read_done(path):
+    """
+    Return the results already in path, dict job id -> result, and cut off
+    a last line that was only partly written.
+    """
+    done = dict()
+    if not os.path.exists(path):
+        return done
+    f = open(path, "r+")
+    try:
+        good = 0   # end of the last complete line
+        for line in iter(f.readline, ""):
+            if not line.endswith("\n"):
+                break
+            try:
+                result = json.loads(line)
+            except ValueError:
+                break
+            done[result["job"]] = result
+            good = f.tell()
+        f.truncate(good)
+    finally:
+        f.close()
+    return done
+
+
+def all_done_round(result):
+    """The round the last peer finished in, or None if some never did."""
+    rounds = result["completion"].values()
+    if None in rounds:
+        return None
+    return max(rounds)
+
+
+def parse_ints(s):
+    return [int(x) for x in s.split(",")]
+
+
+def main(args):
+    usage_msg = ("Usage:  %prog [options] MIX1 [MIX2 ...]\n\n"
+                 "Each MIX is a quoted list of agents as for sim.py, "
+                 "e.g. \"LkjcStd,3 LkjcTyrant,3 Seed,2\"")
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--out",
+                      dest="out", default="sweep.jsonl",
+                      help="Results file; a sweep picks up where it left off")
+
+    parser.add_option("--scale",
+                      dest="scale", default="1",
+                      help="Comma-separated multipliers for each mix's "
+                      "agent counts")
+
+    parser.add_option("--min-bw",
+                      dest="min_up_bw", default="4",
+                      help="Comma-separated min upload bandwidths")
+
+    parser.add_option("--max-bw",
+                      dest="max_up_bw", default="10",
+                      help="Comma-separated max upload bandwidths")
+
+    parser.add_option("--num-pieces",
+                      dest="num_pieces", default="20",
+                      help="Comma-separated numbers of pieces")
+
+    parser.add_option("--blocks-per-piece",
+                      dest="blocks_per_piece", default="4",
+                      help="Comma-separated numbers of blocks per piece")
+
+    parser.add_option("--max-round",
+                      dest="max_round", default=200, type="int",
+                      help="Limit on number of rounds")
+
+    parser.add_option("--iters",
+                      dest="iters", default=10, type="int",
+                      help="Runs of each grid point")
+
+    parser.add_option("--seed",
+                      dest="seed", default=0, type="int",
+                      help="Root random seed")
+
+    parser.add_option("--jobs",
+                      dest="jobs", default=multiprocessing.cpu_count(),
+                      type="int",
+                      help="Number of worker processes")
+
+    (options, mixes) = parser.parse_args(args[1:])
+    if len(mixes) == 0:
+        parser.print_help()
+        sys.exit(1)
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    configure_logging("warning")
+
+    try:
+        mixes = [parse_agents(m.split()) for m in mixes]
+    except ValueError, e:
+        parser.error(str(e))
+
+    # Every grid point, as (agent class names, settings)
+    points = []
+    for (mix, scale, min_bw, max_bw, n, b) in itertools.product(
+            mixes, parse_ints(options.scale), parse_ints(options.min_up_bw),
+            parse_ints(options.max_up_bw), parse_ints(options.num_pieces),
+            parse_ints(options.blocks_per_piece)):
+        if min_bw > max_bw:
+            continue
+        points.append((scale_mix(mix, scale),
+                       dict(min_up_bw=min_bw, max_up_bw=max_bw,
+                            num_pieces=n, blocks_per_piece=b,
+                            max_round=options.max_round, seed=options.seed)))
+
+    # A job's id is the sim's cache key for the run, which covers the
+    # agents' and engine's source: after a code change, resuming reruns
+    # everything instead of mixing in results from the old code.
+    done = read_done(options.out)
+    digests = dict()   # sorted class names -> source digest
+    job_ids = []       # per grid point, the job id of each iteration
+    jobs = []
+    for (names, settings) in points:
+        config = make_config(names, **settings)
+        classes = tuple(sorted(set(names)))
+        if classes not in digests:
+            digests[classes] = source_digest(config.agent_classes)
+        ids = []
+        for i in range(options.iters):
+            seed = derive_seed(options.seed, "iter", i)
+            job_id = iteration_key(config, seed, digests[classes])
+            ids.append(job_id)
+            if job_id not in done:
+                jobs.append((job_id, names, settings, i, seed))
+        job_ids.append(ids)
+
+    total = len(points) * options.iters
+    logging.warning("%d jobs: %d already done, %d to run", total,
+                    total - len(jobs), len(jobs))
+
+    if jobs:
+        out = open(options.out, "a")
+        pool = multiprocessing.Pool(min(options.jobs, len(jobs)), init_worker)
+        try:
+            by_id = dict((job[0], job) for job in jobs)
+            for (job_id, result) in pool.imap_unordered(run_job, jobs):
+                (_, names, settings, i, seed) = by_id[job_id]
+                result.update(job=job_id, classes=names, settings=settings,
+                              iteration=i, seed=seed)
+                out.write(json.dumps(result, sort_keys=True) + "\n")
+                out.flush()
+                os.fsync(out.fileno())
+                done[job_id] = result
+        finally:
+            pool.close()
+            pool.join()
+            out.close()
+
+    # Mean all-done round of each grid point, over the iterations that
+    # finished
+    print "%-40s %5s %5s %6s %4s %6s %10s" % (
+        "mix", "minbw", "maxbw", "pieces", "bpp", "done", "avg round")
+    for ((names, settings), ids) in zip(points, job_ids):
+        stats = RunningStats()
+        for job_id in ids:
+            r = all_done_round(done[job_id])
+            if r is not None:
+                stats.add(r)
+        mix = " ".join("%s,%d" % (name, len(list(group)))
+                       for (name, group) in itertools.groupby(names))
+        print "%-40s %5d %5d %6d %4d %3d/%-2d %10s" % (
+            mix, settings["min_up_bw"], settings["max_up_bw"],
+            settings["num_pieces"], settings["blocks_per_piece"], stats.n,
+            options.iters, "%.2f" % stats.mean() if stats.n else "-")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+"""
+Wall-time limits for calls into agent code, so one slow agent can't stall
+a whole tournament.  Calls are interrupted with SIGALRM where that's
+possible (Unix, main thread).  Elsewhere the call runs to the end and is
+only judged afterwards.
+"""
+
+import time
+import signal
+
+
+class CallTimeout(Exception):
+    pass
+
+
+def call_with_limit(seconds, f, *args):
+    """
+    Return f(*args), or raise CallTimeout if it takes more than seconds of
+    wall time.
+    """
+    # The alarm only counts while f is running: if it goes off after f has
+    # returned, f finished in time and its result is kept.
+    running = [False]
+    def expired(signum, frame):
+        if running[0]:
+            running[0] = False
+            raise CallTimeout()
+
+    try:
+        old_handler = signal.signal(signal.SIGALRM, expired)
+    except (AttributeError, ValueError):
+        # No SIGALRM, or not the main thread: can't interrupt
+        start = time.time()
+        result = f(*args)
+        if time.time() - start > seconds:
+            raise CallTimeout()
+        return result
+
+    try:
+        running[0] = True
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+        try:
+            return f(*args)
+        finally:
+            running[0] = False
+    finally:
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        finally:
+            signal.signal(signal.SIGALRM, old_handler)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+"""
+Runs agent mixes against each other over a grid of configs, spread over a
+pool of worker processes, and prints a leaderboard of the agent classes.
+
+Each (mix, config, iteration) result is cached on disk under the same key
+sim.py uses (sim.iteration_key: a hash of the agents' and engine's source,
+the config and the seed), so running the same tournament again only
+reruns what changed.  Iteration
+i of a mix uses the same seed as iteration i of
+
+    sim.py --seed SEED <mix>
+
+so results can be checked against single runs.
+"""
+
+import os
+import sys
+import logging
+import itertools
+import multiprocessing
+from optparse import OptionParser
+
+from sim import make_config, parse_agents, run_iteration, configure_logging
+from sim import iteration_key
+from util import derive_seed, RunningStats
+from cache import ResultCache, source_digest
+
+
+def init_worker():
+    # Agents print from post_init()
+    sys.stdout = open(os.devnull, "w")
+
+
+def run_job(job):
+    """
+    job: (job index, agent class names, settings dict, iteration, seed)
+
+    Returns (job index, result), where result is a JSON-able dict shaped
+    like the results sim.py caches.
+    """
+    (n, names, settings, iteration, seed) = job
+    config = make_config(names, **settings)
+    (peer_ids, uploaded, completion, overruns, profile) = run_iteration(
+        (config, iteration, seed))
+    return (n, {"peer_ids": peer_ids,
+                "uploaded": uploaded,
+                "completion": completion})
+
+
+class Leaderboard:
+    """
+    Per agent class stats over every peer of that class in every result:
+    how often it finished, the mean round it finished in, and the mean
+    blocks it uploaded.
+    """
+    def __init__(self):
+        self.runs = dict()        # class name -> peers counted
+        self.finished = dict()    # class name -> peers that finished
+        self.completion = dict()  # class name -> RunningStats
+        self.uploaded = dict()    # class name -> RunningStats
+
+    def add(self, names, result):
+        """names: the agent class of each peer in the run"""
+        for (name, pid) in zip(names, result["peer_ids"]):
+            if name not in self.runs:
+                self.runs[name] = 0
+                self.finished[name] = 0
+                self.completion[name] = RunningStats()
+                self.uploaded[name] = RunningStats()
+            self.runs[name] += 1
+            self.uploaded[name].add(result["uploaded"][pid])
+            c = result["completion"][pid]
+            if c is not None:
+                self.finished[name] += 1
+                self.completion[name].add(c)
+
+    def rows(self, skip=("Seed",)):
+        """
+        (class name, peers, finish rate, mean completion round, mean
+        uploaded) tuples, best first: most often finished, then fastest.
+        Classes in skip (seeds start out finished) are left out.
+        """
+        ans = []
+        for name in self.runs:
+            if name in skip:
+                continue
+            rate = float(self.finished[name]) / self.runs[name]
+            c = self.completion[name]
+            mean_c = c.mean() if c.n > 0 else None
+            ans.append((name, self.runs[name], rate, mean_c,
+                        self.uploaded[name].mean()))
+        ans.sort(key=lambda r: (-r[2], r[3]))
+        return ans
+
+    def pretty(self):
+        lines = ["%4s %-20s %7s %9s %11s %9s" % (
+            "rank", "agent", "peers", "finished", "avg round", "avg up")]
+        for (i, (name, runs, rate, mean_c, mean_up)) in enumerate(self.rows()):
+            lines.append("%4d %-20s %7d %8.1f%% %11s %9.1f" % (
+                i + 1, name, runs, 100 * rate,
+                "-" if mean_c is None else "%.2f" % mean_c, mean_up))
+        return "\n".join(lines)
+
+
+def parse_ints(s):
+    return [int(x) for x in s.split(",")]
+
+
+def main(args):
+    usage_msg = ("Usage:  %prog [options] MIX1 [MIX2 ...]\n\n"
+                 "Each MIX is a quoted list of agents as for sim.py, "
+                 "e.g. \"LkjcStd,3 LkjcTyrant,3 Seed,2\"")
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--mixes",
+                      dest="mixes_file", default=None,
+                      help="Read more mixes from this file, one per line")
+
+    parser.add_option("--num-pieces",
+                      dest="num_pieces", default="20",
+                      help="Comma-separated numbers of pieces to run each "
+                      "mix with")
+
+    parser.add_option("--blocks-per-piece",
+                      dest="blocks_per_piece", default="4",
+                      help="Comma-separated numbers of blocks per piece")
+
+    parser.add_option("--max-round",
+                      dest="max_round", default=200, type="int",
+                      help="Limit on number of rounds")
+
+    parser.add_option("--min-bw",
+                      dest="min_up_bw", default=4, type="int",
+                      help="Min upload bandwidth")
+
+    parser.add_option("--max-bw",
+                      dest="max_up_bw", default=10, type="int",
+                      help="Max upload bandwidth")
+
+    parser.add_option("--iters",
+                      dest="iters", default=10, type="int",
+                      help="Runs of each mix and config")
+
+    parser.add_option("--seed",
+                      dest="seed", default=0, type="int",
+                      help="Root random seed")
+
+    parser.add_option("--jobs",
+                      dest="jobs", default=multiprocessing.cpu_count(),
+                      type="int",
+                      help="Number of worker processes")
+
+    parser.add_option("--cache-dir",
+                      dest="cache_dir", default=".tournament-cache",
+                      help="Directory for cached results")
+
+    parser.add_option("--rerun",
+                      dest="rerun", default=False, action="store_true",
+                      help="Ignore cached results (new ones are still saved)")
+
+    (options, mixes) = parser.parse_args(args[1:])
+    if options.mixes_file is not None:
+        f = open(options.mixes_file)
+        try:
+            mixes.extend(line.strip() for line in f
+                         if line.strip() and not line.startswith("#"))
+        finally:
+            f.close()
+    if len(mixes) == 0:
+        parser.print_help()
+        sys.exit(1)
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    configure_logging("warning")
+
+    try:
+        mixes = [parse_agents(m.split()) for m in mixes]
+    except ValueError, e:
+        parser.error(str(e))
+
+    grid = [dict(num_pieces=n, blocks_per_piece=b,
+                 max_round=options.max_round, min_up_bw=options.min_up_bw,
+                 max_up_bw=options.max_up_bw, seed=options.seed)
+            for (n, b) in itertools.product(parse_ints(options.num_pieces),
+                                            parse_ints(options.blocks_per_piece))]
+
+    cache = ResultCache(options.cache_dir)
+    digests = dict()   # sorted class names -> source digest
+    results = dict()   # job index -> result
+    jobs = []
+    keys = []
+    job_names = []     # job index -> agent class names
+    for names in mixes:
+        classes = tuple(sorted(set(names)))
+        for settings in grid:
+            config = make_config(names, **settings)
+            if classes not in digests:
+                digests[classes] = source_digest(config.agent_classes)
+            for i in range(options.iters):
+                seed = derive_seed(options.seed, "iter", i)
+                key = iteration_key(config, seed, digests[classes])
+                n = len(keys)
+                keys.append(key)
+                job_names.append(names)
+                cached = None if options.rerun else cache.get(key)
+                if cached is not None:
+                    results[n] = cached
+                else:
+                    jobs.append((n, names, settings, i, seed))
+
+    logging.warning("%d runs: %d cached, %d to run", len(keys),
+                    len(keys) - len(jobs), len(jobs))
+
+    if jobs:
+        n_workers = min(options.jobs, len(jobs))
+        pool = multiprocessing.Pool(n_workers, init_worker)
+        try:
+            for (n, result) in pool.imap_unordered(run_job, jobs):
+                cache.put(keys[n], result)
+                results[n] = result
+        finally:
+            pool.close()
+            pool.join()
+
+    board = Leaderboard()
+    for n in range(len(keys)):
+        board.add(job_names[n], results[n])
+    print board.pretty()
+
+if __name__ == "__main__":
+    main(sys.argv)
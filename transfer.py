@@ -0,0 +1,223 @@
+#!/usr/bin/python
+
+"""
+Working out what a round's uploads deliver: for each requester, how many
+blocks of each piece it gets and from whom.
+
+Each uploader's bandwidth to a requester is applied in order to the
+requests the requester sent it, up to what each piece still needs.  A
+piece requested from several uploaders isn't stacked: the requester gets
+the most blocks any one of them sent, from the first uploader (in peer id
+order) that sent that many.
+
+resolve_transfers() does this off an index of the round's uploads, built
+once.  resolve_transfers_reference() is the original version, which
+looks up every (uploader, requester) pair in the uploader's batch; it's
+kept to check the indexed one against.  Running this module compares the
+two on random rounds (see self_check()); bench.py --check compares them
+over whole simulations.
+"""
+
+import sys
+import random
+import itertools
+
+from messages import RequestBatch, UploadBatch
+
+
+def upload_index(uploads, peer_index):
+    """
+    uploads: dict peer_id -> UploadBatch
+
+    Return dict requester index -> dict uploader index -> bandwidth, from
+    the first upload in each uploader's batch to each requester, as
+    UploadBatch.rate_to() would give it.
+    """
+    index = dict()
+    for (uploader_id, batch) in uploads.iteritems():
+        u = peer_index[uploader_id]
+        peers = batch.peers
+        for k in xrange(len(peers)):
+            r = peers[k]
+            if r < 0:
+                continue   # not to a peer
+            rates = index.get(r)
+            if rates is None:
+                rates = index[r] = dict()
+            if u not in rates:
+                rates[u] = batch.bw(k)
+    return index
+
+
+def sort_positions(peer_ids):
+    """List, peer index -> position of its id among the sorted ids."""
+    order = sorted(xrange(len(peer_ids)), key=peer_ids.__getitem__)
+    positions = [0] * len(peer_ids)
+    for (position, i) in enumerate(order):
+        positions[i] = position
+    return positions
+
+
+def resolve_transfers(requests, uploads, peer_ids, peer_index,
+                      blocks_per_piece, id_order=None):
+    """
+    requests, uploads: dict peer_id -> RequestBatch / UploadBatch
+    peer_ids, peer_index: peer ids in index order, and id -> index
+    id_order: sort_positions(peer_ids).  Computed if not given; the sim
+        works it out once per run.
+
+    Return dict requester_id -> list of (piece_id, blocks, uploader_id),
+    one per piece the requester got blocks of.
+    """
+    if id_order is None:
+        id_order = sort_positions(peer_ids)
+    index = upload_index(uploads, peer_index)
+    rank = id_order.__getitem__
+    transfers = dict()
+    for requester_id in requests:
+        # piece -> (blocks, uploader index), best so far
+        got = dict()
+        rates = index.get(peer_index[requester_id])
+        if rates:
+            batch = requests[requester_id]
+            pieces = batch.pieces
+            # The rows asking each uploader that's uploading to us, in
+            # batch order
+            rows = dict()
+            peers = batch.peers
+            for k in xrange(len(peers)):
+                u = peers[k]
+                if rates.get(u, 0) != 0:
+                    if u in rows:
+                        rows[u].append(k)
+                    else:
+                        rows[u] = [k]
+            for u in sorted(rows, key=rank):
+                bw = rates[u]
+                # This bandwidth gets applied in order to each piece requested
+                for k in rows[u]:
+                    alloced_bw = min(bw, blocks_per_piece - batch.start(k))
+                    piece_id = pieces[k]
+                    best = got.get(piece_id)
+                    if best is None or alloced_bw > best[0]:
+                        got[piece_id] = (alloced_bw, u)
+                    bw -= alloced_bw
+                    if bw == 0:
+                        break
+        transfers[requester_id] = [
+            (piece_id, blocks, peer_ids[u])
+            for (piece_id, (blocks, u)) in got.iteritems()]
+    return transfers
+
+
+def resolve_transfers_reference(requests, uploads, peer_ids, peer_index,
+                                blocks_per_piece, id_order=None):
+    """
+    resolve_transfers() the way the sim used to do it: sort and group each
+    requester's requests by uploader id, and look for an upload to the
+    requester in each uploader's batch.  Same arguments and result.
+    """
+    transfers = dict()
+    for requester_id in requests:
+        # Keep track of how many blocks of each piece this
+        # requester got.  piece -> (blocks, from_who)
+        new_blocks_per_piece = dict()
+        def update_count(piece_id, blocks, peer_id):
+            if piece_id in new_blocks_per_piece:
+                old = new_blocks_per_piece[piece_id][0]
+                if blocks > old:
+                    new_blocks_per_piece[piece_id] = (blocks, peer_id)
+            else:
+                new_blocks_per_piece[piece_id] = (blocks, peer_id)
+
+        # Group the requests (row numbers in the batch) by peer
+        # that is being asked
+        batch = requests[requester_id]
+        get_peer_id = lambda k: peer_ids[batch.peers[k]]
+        rows = sorted(xrange(len(batch)), key=get_peer_id)
+        for peer_id, rows_for_peer in itertools.groupby(rows, get_peer_id):
+            bw = uploads[peer_id].rate_to(peer_index[requester_id])
+            if bw == 0:
+                continue
+            # This bandwidth gets applied in order to each piece requested
+            for k in rows_for_peer:
+                needed_blocks = blocks_per_piece - batch.start(k)
+                alloced_bw = min(bw, needed_blocks)
+                update_count(batch.pieces[k], alloced_bw, peer_id)
+                bw -= alloced_bw
+                if bw == 0:
+                    break
+        transfers[requester_id] = [
+            (piece_id, blocks, peer_id)
+            for (piece_id, (blocks, peer_id)) in new_blocks_per_piece.iteritems()]
+    return transfers
+
+
+def random_round(rng, num_peers, num_pieces, blocks_per_piece):
+    """
+    Random requests and uploads for one round, as (requests, uploads,
+    peer_ids, peer_index).  They go out of their way to include the
+    awkward cases: peer ids that sort differently from their indexes,
+    several uploads from one uploader to the same requester, uploads of 0
+    and fractional bandwidth, uploads to non-peers, the same piece asked
+    of several uploaders, and requests for pieces the requester already
+    has all of.
+    """
+    peer_ids = ["P%d" % n for n in rng.sample(xrange(10 * num_peers),
+                                              num_peers)]
+    peer_index = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+    bws = [0, 0.5] + range(1, 2 * blocks_per_piece + 1)
+
+    requests = dict()
+    uploads = dict()
+    for (i, pid) in enumerate(peer_ids):
+        others = [j for j in xrange(num_peers) if j != i]
+        batch = RequestBatch(pid, peer_ids)
+        for n in xrange(rng.randint(0, 3 * num_pieces)):
+            start = rng.randint(0, blocks_per_piece)   # may be complete
+            if start < blocks_per_piece and rng.random() < 0.2:
+                start += 0.5
+            batch.add(rng.choice(others), rng.randrange(num_pieces), start)
+        requests[pid] = batch
+
+        batch = UploadBatch(pid, peer_ids)
+        for n in xrange(rng.randint(0, 4)):
+            if rng.random() < 0.05:
+                to = -1
+            else:
+                to = rng.choice(others)
+            batch.add(to, rng.choice(bws))
+            if to >= 0 and rng.random() < 0.2:
+                batch.add(to, rng.choice(bws))   # a second upload to to
+        uploads[pid] = batch
+    return (requests, uploads, peer_ids, peer_index)
+
+
+def self_check(rounds=2000, seed=0):
+    """
+    Compare resolve_transfers() with resolve_transfers_reference() on
+    random rounds of random sizes.  Prints the first round they differ on,
+    if any, and returns the number of rounds that differed.
+    """
+    rng = random.Random(seed)
+    failures = 0
+    for n in xrange(rounds):
+        blocks_per_piece = rng.randint(1, 5)
+        (requests, uploads, peer_ids, peer_index) = random_round(
+            rng, rng.randint(2, 12), rng.randint(1, 8), blocks_per_piece)
+        args = (requests, uploads, peer_ids, peer_index, blocks_per_piece)
+        expected = resolve_transfers_reference(*args)
+        for ans in (resolve_transfers(*args),
+                    resolve_transfers(*(args + (sort_positions(peer_ids),)))):
+            if ans != expected:
+                if failures == 0:
+                    print "Round %d differs:\n  got      %s\n  expected %s" % (
+                        n, ans, expected)
+                failures += 1
+                break
+    print "%d of %d random rounds differed" % (failures, rounds)
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if self_check() else 0)
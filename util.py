@@ -5,6 +5,7 @@
 # http://stackoverflow.com/questions/5098580/implementing-argmax-in-python
 
 from itertools import imap, izip, count
+import hashlib
 import math
 
 
@@ -44,6 +45,35 @@ def stddev(lst):
     return math.sqrt(sum((x-m)*(x-m) for x in lst) / len(lst))
 
 
+class RunningStats:
+    """
+    Streaming mean and standard deviation, so the values themselves never
+    need to be kept.  mean() gives the same answer as mean(lst); stddev()
+    uses Welford's method and matches stddev(lst) up to rounding.
+    """
+    def __init__(self):
+        self.n = 0
+        self.total = 0
+        self._mean = 0.0
+        self._m2 = 0.0   # sum of squared differences from the mean
+
+    def add(self, x):
+        self.n += 1
+        self.total += x
+        delta = x - self._mean
+        self._mean += delta / float(self.n)
+        self._m2 += delta * (x - self._mean)
+
+    def mean(self):
+        """Throws a div by zero exception if nothing was added"""
+        return self.total / float(self.n)
+
+    def stddev(self):
+        if self.n == 0:
+            return 0
+        return math.sqrt(self._m2 / self.n)
+
+
 def median(numeric):
     vals = sorted(numeric)
     count = len(vals)
@@ -86,6 +116,19 @@ def even_split(n, k):
     return ans
 
 
+def derive_seed(root, *labels):
+    """
+    Return a 32-bit seed derived from root and any number of labels (ints or
+    strings).  The same arguments always give the same seed, and different
+    labels give unrelated seeds.
+
+    >>> derive_seed(1, "iter", 0) == derive_seed(1, "iter", 0)
+    True
+    """
+    key = ":".join(str(x) for x in (root,) + labels)
+    return int(hashlib.sha1(key).hexdigest()[:8], 16)
+
+
 def load_modules(agent_classes):
     """Each agent class must be in module class_name.lower().
     Returns a dictionary class_name->class"""
@@ -100,6 +143,24 @@ def load_modules(agent_classes):
     
 
 
+class LazyStr:
+    """
+    A log message argument that isn't built until it's needed: str() calls
+    f(*args).  logging only formats its arguments when a record is
+    actually emitted, so
+
+        logging.debug("%s", LazyStr(history.pretty_for_round, r))
+
+    costs nothing when debug logging is off.
+    """
+    def __init__(self, f, *args):
+        self.f = f
+        self.args = args
+
+    def __str__(self):
+        return str(self.f(*self.args))
+
+
 class Params:
     def __init__(self):
         self._init_keys = set(self.__dict__.keys())